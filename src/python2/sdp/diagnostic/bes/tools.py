@@ -1,7 +1,25 @@
 import matplotlib
+from matplotlib import animation
 import matplotlib.pyplot as plt
+from matplotlib.tri import Triangulation
+# registers the '3d' projection used in crosscorrelation
+from mpl_toolkits.mplot3d import Axes3D
 import numpy as np
+from scipy.fftpack import next_fast_len
 from scipy.interpolate import interp2d, splev, splrep
+from scipy.sparse import csr_matrix
+from scipy.spatial import Delaunay
+
+try:
+    # scipy >= 1.4, the FFTs can use several threads
+    from scipy.fft import rfft, irfft, rfft2, irfft2
+    def fft_kwargs(workers):
+        return {} if workers is None else {'workers': workers}
+except ImportError:
+    from numpy.fft import rfft, irfft, rfft2, irfft2
+    def fft_kwargs(workers):
+        # numpy.fft is single threaded
+        return {}
 
 import sdp.diagnostic.bes.bes as bes_
 import sdp.plasma.xgc.loader_local as xgc_
@@ -10,6 +28,41 @@ import sdp.plasma.xgc.loader_local as xgc_
 pgf_with_rc_fonts = {"pgf.texsystem": "pdflatex"}
 matplotlib.rcParams.update(pgf_with_rc_fonts)
 
+def correlation_coefficients(I,iref):
+    """ Compute the correlation coefficients between a reference signal and all the signals.
+    Give the same values than np.corrcoef(I[:,iref],I[:,j])[0,1] for each j, but in a single
+    matrix product.
+
+    :param np.array[Nt,N] I: Signals (time is the first index)
+    :param int iref: Index of the reference signal
+
+    :returns: Correlation coefficients
+    :rtype: np.array[N]
+    """
+    X = I - np.mean(I,axis=0)
+    norm = np.sqrt(np.sum(X**2,axis=0))
+    return X.T.dot(X[:,iref])/(norm*norm[iref])
+
+def spline_matrix(x,xnew):
+    """ Compute the matrix of the interpolating cubic spline from x to xnew.
+    The spline (splrep with the default parameters) is linear with respect to the data,
+    therefore the matrix is obtained by interpolating each vector of the canonical basis
+    and can be applied to any number of signals sampled at x.
+
+    :param np.array[N] x: Position of the data (sorted)
+    :param np.array[M] xnew: Position wanted
+
+    :returns: Interpolation matrix
+    :rtype: np.array[M,N]
+    """
+    M = np.zeros((xnew.shape[0],x.shape[0]))
+    e = np.zeros(x.shape[0])
+    for k in range(x.shape[0]):
+        e[k] = 1.0
+        M[:,k] = splev(xnew,splrep(x,e))
+        e[k] = 0.0
+    return M
+
 class Tools:
     """ Defines a few tools for doing some computations on the bes image
 
@@ -23,15 +76,23 @@ class Tools:
     :param np.array[Nfib] psin: :math:`\Psi_n` value
     :param str name_id: Name defining the data (used for the titles))
     :param bool I_fluc: Input are fluctuation or total intensity
+    :param dtype: Type of the fluctuations. By default, the type of the data is kept (double
+    precision for float64 data). np.float32 halves the memory of the fluctuations, of the cached
+    interpolation weights and of the interpolated grids, at the cost of single precision results.
     """
 
-    def __init__(self,I,R,Z,psin,name_id,I_fluc=False):
+    def __init__(self,I,R,Z,psin,name_id,I_fluc=False,dtype=None):
         if I_fluc == False:
             self.Itot = I
             Iav = np.mean(I,axis=0)
-            self.I = (I-Iav)/Iav
+            if dtype is None:
+                dtype = np.result_type(I,Iav)
+            # normalization done in place (no temporary arrays)
+            self.I = np.empty(I.shape,dtype=dtype)
+            np.subtract(I,Iav,out=self.I)
+            self.I /= Iav
         else:
-            self.I = I
+            self.I = np.asarray(I,dtype=dtype)
 
         self.name_id = name_id
         self.R = R
@@ -39,15 +100,18 @@ class Tools:
         self.psin = psin
         self.Nfoc = Z.shape[0]
         self.Nt = I.shape[0]
+        # linear interpolation weights on the meshes, see interpolate
+        self._interp_weights = {}
 
     @classmethod
-    def init_from_file(cls,filename,name_id,fluc=False):
+    def init_from_file(cls,filename,name_id,fluc=False,dtype=None):
         """ Load of file in the numpy format (npz)
 
         The data inside it should be in the following order: [I,psin,pos_foc,...]
 
         :param str filename: Name of the file
         :param bool fluc: The intensity inside the file is the total (False) or the fluctuation (True)
+        :param dtype: Type of the fluctuations (type of the data by default)
         :return: New instance variable
         :rtype: Tools
 
@@ -56,18 +120,23 @@ class Tools:
         I = data['arr_0']
         psin = data['arr_1']
         pos = data['arr_2']
-        R = np.sqrt(np.sum(pos[:,0:2]**2,axis=1))
+        R = np.hypot(pos[:,0],pos[:,1])
         Z = pos[:,2]
-        return cls(I,R,Z,psin,name_id,fluc)
+        return cls(I,R,Z,psin,name_id,fluc,dtype)
 
     def interpolate(self,Nr,Nz,I,timestep=None,kind='linear',start=40):
         """ Interpolate all the data on a spatial mesh and create this mesh.
         The interpolation is done for each timestep
 
+        For the linear interpolation, the weights of the fibers on the mesh are computed once
+        (see :func:`interpolation_weights`) and all the timesteps are interpolated
+        with a single sparse matrix product.
+
         :param int Nr: Number of points for the discretization in R
         :param int Nz: Number of points for the discretization in Z
         :param np.array[Ntime,R,Z] I: Picture to interpolate
         :param int timestep: Time step wanted (None compute all of them)
+        :param str kind: Kind of interpolation ('linear', 'cubic' or 'quintic')
 
         :return: r,z of the mesh and I on the mesh
         :rtype: tuple(np.array[Nr],np.array[Nz],np.array[Ntime,Nr,Nz])
@@ -75,7 +144,20 @@ class Tools:
         r = np.linspace(np.min(self.R),np.max(self.R),Nr)
         z = np.linspace(np.min(self.Z),np.max(self.Z),Nz)
 
-        if timestep is None:
+        if kind == 'linear':
+            W = self.interpolation_weights(Nr,Nz)
+            if timestep is None:
+                I = I[:self.Nt-start,:]
+                Igrid = np.empty((I.shape[0],Nr,Nz),dtype=np.result_type(W.dtype,I.dtype))
+                # the timesteps are done by blocks of about 1MB in order to stay in the cache
+                # and to avoid a temporary array of the size of the output
+                step = max(1,2**20//(Nr*Nz*Igrid.itemsize))
+                Iflat = Igrid.reshape((I.shape[0],Nr*Nz))
+                for i in range(0,I.shape[0],step):
+                    Iflat[i:i+step,:] = W.dot(I[i:i+step,:].T).T
+            else:
+                Igrid = W.dot(I[timestep,:]).reshape((Nr,Nz))
+        elif timestep is None:
             Igrid = np.zeros((self.Nt-start,Nr,Nz))
             for i in range(self.Nt-start):
                 temp = interp2d(self.R,self.Z,I[i,:],kind)
@@ -86,6 +168,47 @@ class Tools:
             Igrid = temp(r,z).T
         return r,z,Igrid
 
+    def interpolation_weights(self,Nr,Nz):
+        """ Compute the weights of the linear interpolation of the fibers on the mesh
+        used by :func:`interpolate`.
+
+        The fibers are triangulated and the barycentric coordinates of each point of the mesh
+        are stored in a sparse matrix (with the same type than the fluctuations). The points outside
+        the convex hull of the fibers have a value of 0. The matrix is cached for each mesh size.
+
+        :param int Nr: Number of points for the discretization in R
+        :param int Nz: Number of points for the discretization in Z
+
+        :return: Interpolation matrix (the mesh is flattened in C order)
+        :rtype: scipy.sparse.csr_matrix[Nr*Nz,Nfib]
+        """
+        if (Nr,Nz) in self._interp_weights:
+            return self._interp_weights[(Nr,Nz)]
+
+        r = np.linspace(np.min(self.R),np.max(self.R),Nr)
+        z = np.linspace(np.min(self.Z),np.max(self.Z),Nz)
+        r,z = np.meshgrid(r,z,indexing='ij')
+        pts = np.array([r.flatten(),z.flatten()]).T
+
+        tri = Delaunay(np.array([self.R,self.Z]).T)
+        simplex = tri.find_simplex(pts)
+        ind = simplex >= 0
+        simplex = simplex[ind]
+        # barycentric coordinates
+        T = tri.transform[simplex]
+        b = np.einsum('ijk,ik->ij',T[:,:2,:],pts[ind]-T[:,2,:])
+        w = np.zeros((b.shape[0],3))
+        w[:,:2] = b
+        w[:,2] = 1.0 - np.sum(b,axis=1)
+
+        rows = np.repeat(np.nonzero(ind)[0],3)
+        # floating type of the fluctuations (float64 for integer data)
+        W = csr_matrix((w.flatten(),(rows,tri.simplices[simplex].flatten())),
+                       shape=(pts.shape[0],self.R.shape[0]),
+                       dtype=np.result_type(self.I.dtype,np.float32))
+        self._interp_weights[(Nr,Nz)] = W
+        return W
+
     def fluctuations_picture(self,timestep,v=40,total=False):
         """ Plot a graph of the fluctuation
 
@@ -115,7 +238,6 @@ class Tools:
         :param int v: Number of ticks for the colorbar
         :param str name_movie: Name of the movie that will be saved
         """
-        from matplotlib import animation
         fig = plt.figure()
         ax = plt.gca()
 
@@ -123,14 +245,16 @@ class Tools:
         plt.ylabel('Z[m]')
 
         v = np.linspace(np.min(self.I),np.max(self.I),v)
+        # the fibers do not move, triangulate them only once
+        tri = Triangulation(self.R,self.Z)
 
         def animate(i):
             ax.cla()
             print 'Timestep: ', i
             plt.title('Timestep : {}'.format(i))
-            plt.tricontourf(self.R,self.Z,self.I[i,:],v)
+            plt.tricontourf(tri,self.I[i,:],v)
             plt.plot(self.R,self.Z,'x')
-            plt.tricontour(self.R,self.Z,self.psin,[1])
+            plt.tricontour(tri,self.psin,[1])
             fig.canvas.draw()
             return None
 
@@ -185,13 +309,16 @@ class Tools:
         axarr[1].set_yticklabels([])
         #plt.suptitle('Timestep : {}'.format(timestep))
 
+        # the fibers of self are used for three plots: triangulate once
+        tri = Triangulation(self.R,self.Z)
+
         axarr[0].plot(tool2.R,tool2.Z,'x')
         tri0 = axarr[0].tricontourf(tool2.R,tool2.Z,I2[timestep,:],v2)
-        axarr[0].tricontour(self.R,self.Z,self.psin,[1])
+        axarr[0].tricontour(tri,self.psin,[1])
 
         axarr[1].plot(self.R,self.Z,'x')
-        tri1 = axarr[1].tricontourf(self.R,self.Z,I[timestep,:],v1)
-        axarr[1].tricontour(self.R,self.Z,self.psin,[1])
+        tri1 = axarr[1].tricontourf(tri,I[timestep,:],v1)
+        axarr[1].tricontour(tri,self.psin,[1])
 
 
         cb = plt.colorbar(tri0,ax=axarr[0])
@@ -211,7 +338,6 @@ class Tools:
         """
         Nr = 100
         Nz = 120
-        from matplotlib import animation
         if interpolation:
             r,z,I_id = self.interpolate(Nr,Nz,self.I)
             r,z,I = self.interpolate(Nr,Nz,tool2.I)
@@ -229,39 +355,55 @@ class Tools:
         axarr[0].set_ylabel('Z[m]')
         axarr[1].set_xlabel('R[m]')
 
+        # the triangulations are computed only once for the whole movie
+        tri_id = Triangulation(self.R,self.Z)
+        tri2 = Triangulation(tool2.R,tool2.Z)
 
-        tri0 = axarr[1].tricontourf(self.R,self.Z,self.I[0,:],v1)
-        tri1 = axarr[0].tricontourf(tool2.R,tool2.Z,tool2.I[0,:],v2)
+        tri0 = axarr[1].tricontourf(tri_id,self.I[0,:],v1)
+        tri1 = axarr[0].tricontourf(tri2,tool2.I[0,:],v2)
 
         cb = plt.colorbar(tri0,ax=axarr[0])
         cb = plt.colorbar(tri1,ax=axarr[1])
 
+        # static part of the pictures
+        axarr[0].locator_params(axis = 'x',nbins=5)
+        axarr[1].locator_params(axis = 'x',nbins=5)
+        axarr[1].set_title(tool2.name_id)
+        axarr[0].set_title(self.name_id)
+        axarr[1].set_yticklabels([])
+
+        axarr[0].plot(tool2.R,tool2.Z,'x')
+        axarr[1].tricontour(tri2,tool2.psin,[1])
+        axarr[1].plot(self.R,self.Z,'x')
+        axarr[0].tricontour(tri_id,self.psin,[1])
+
+        # contours of the previous timestep (removed at each timestep instead of clearing the axes)
+        contours = [tri0,tri1]
+
+        def remove_contour(cs):
+            try:
+                cs.remove()
+            except AttributeError:
+                # old version of matplotlib
+                for c in cs.collections:
+                    c.remove()
 
         def animate(i):
             print 'Timestep: ', i
-            axarr[0].cla()
-            axarr[0].locator_params(axis = 'x',nbins=5)
-            axarr[1].cla()
-            axarr[1].locator_params(axis = 'x',nbins=5)
-            axarr[1].set_title(tool2.name_id)
-            axarr[0].set_title(self.name_id)
-
-            axarr[1].set_yticklabels([])
             plt.suptitle('Timestep : {}'.format(i))
+            for cs in contours:
+                remove_contour(cs)
 
-            axarr[0].plot(tool2.R,tool2.Z,'x')
             if interpolation:
                 tri0 = axarr[1].contourf(r,z,I[i,...].T,v2,extend='both')
             else:
-                tri0 = axarr[1].tricontourf(tool2.R,tool2.Z,tool2.I[i,:],v2,extend='both')
-            axarr[1].tricontour(tool2.R,tool2.Z,tool2.psin,[1])
+                tri0 = axarr[1].tricontourf(tri2,tool2.I[i,:],v2,extend='both')
 
-            axarr[1].plot(self.R,self.Z,'x')
             if interpolation:
                 tri1 = axarr[0].contourf(r,z,I_id[i,...].T,v1,extend='both')
             else:
-                tri1 = axarr[0].tricontourf(self.R,self.Z,self.I[i,:],v1,extend='both')
-            axarr[0].tricontour(self.R,self.Z,self.psin,[1])
+                tri1 = axarr[0].tricontourf(tri_id,self.I[i,:],v1,extend='both')
+            contours[:] = [tri0,tri1]
 
             fig.canvas.draw()
             return None
@@ -279,7 +421,8 @@ class Tools:
         anim.save(name_movie, writer=FFwriter,fps=15, extra_args=['-vcodec', 'libx264'])
 
 
-    def crosscorrelation(self, Nr=60, Nz=70, dr_max=0.1, dz_max=0.03, dkr_max=300, dkz_max=300, graph='3d',figure=True,start=40):
+    def crosscorrelation(self, Nr=60, Nz=70, dr_max=0.1, dz_max=0.03, dkr_max=300, dkz_max=300, graph='3d',figure=True,start=40,
+                         workers=None):
         """ Plot or just compute the shape of the crosscorrelation from the point R[0],Z[0]
 
         :param int Nr: Number of points for the discretization
@@ -291,49 +434,53 @@ class Tools:
         :param str graph: Choice between surface or contourf graph ('2d')
         :param bool figure: Choice between plot or computing
         :param int start: First time step to use
+        :param int workers: Number of threads used by the FFTs (scipy >= 1.4 only, one thread by default,\
+        -1 for all the cores)
 
         :return: If (figure == False), the correlation and its fourier transform are returned.\
         The size of the two arrays is defined by the cutoff limits (dr_max,dkr_max,...))
         :rtype: (np.array[R,Z],np.array[R,Z])
         """
-        from scipy.signal import correlate2d
-
-        corr = np.zeros(2*np.array([Nr,Nz])-1)
-
         r,z,Igrid = self.interpolate(Nr,Nz,self.I,start=start)
 
-        for i in range(self.Nt-start):
-            if np.isfinite(Igrid[i,...]).all():
-                corr += correlate2d(Igrid[i,...],Igrid[i,...])
-            else:
-                print 'miss'
-
-
-        corr /= np.max(corr)
-        temp = np.zeros(2*Nr-1)
+        # remove the timesteps with some invalid values
+        good = np.isfinite(Igrid).all(axis=(1,2))
+        if not good.all():
+            print 'miss: ', np.sum(~good)
+
+        # the sum of the autocorrelations is computed in the Fourier space,
+        # the zero padding avoids the aliasing of the circular correlation
+        # and is extended up to a size efficient for the FFT
+        s = (next_fast_len(2*Nr-1),next_fast_len(2*Nz-1))
+        Ifft = rfft2(Igrid[good],s=s,**fft_kwargs(workers))
+        psd = np.sum(np.abs(Ifft)**2,axis=0)
+        corr = irfft2(psd,s=s,**fft_kwargs(workers))
+        # keep the shifts between -(N-1) and N-1
+        corr = corr[np.ix_(np.arange(1-Nr,Nr) % s[0],np.arange(1-Nz,Nz) % s[1])]
+
+        corr_max = np.max(corr)
+        corr /= corr_max
+        # the spectrum of the correlation is the power spectral density
+        fft_corr = psd/(corr_max*np.sqrt(Nr*Nz))
+        # shifts from -(N-1) to N-1
         r = r-r[0]
         z = z-z[0]
-        temp[:Nr-1] = -r[Nr-1:0:-1]
-        temp[Nr-1:] = r
-        r = temp
-        temp = np.zeros(2*Nz-1)
-        temp[:Nz-1] = -z[Nz-1:0:-1]
-        temp[Nz-1:] = z
-        z = temp
-
-        indr_ = (r >= 0) & (r<dr_max)
-        indz_ = (z >= 0) & (z<dz_max)
-        ind = np.einsum('i,j->ij',indr_,indz_)
+        r = np.concatenate((-r[:0:-1],r))
+        z = np.concatenate((-z[:0:-1],z))
+
+        # r and z are sorted, the wanted shifts are a contiguous part of them
+        indr_ = slice(*np.searchsorted(r,[0.0,dr_max]))
+        indz_ = slice(*np.searchsorted(z,[0.0,dz_max]))
 
         rm, zm = np.meshgrid(r[indr_],z[indz_])
-        fft_corr = np.abs(np.fft.fft2(corr))/np.sqrt(Nr*Nz)
-        corr = corr[ind]
-        corr = np.reshape(corr,[np.sum(indr_),np.sum(indz_)])
-
-        krfft = np.fft.fftfreq(Nr,r[2]-r[1])
-        kzfft = np.fft.fftfreq(Nz,z[2]-z[1])
-        indrfft = (krfft >= 0) & (krfft < dkr_max)
-        indzfft = (kzfft >= 0) & (kzfft < dkz_max)
+        corr = corr[indr_,indz_]
+
+        krfft = np.fft.fftfreq(s[0],r[2]-r[1])
+        kzfft = np.fft.rfftfreq(s[1],z[2]-z[1])
+        # the positive frequencies are sorted at the beginning
+        indrfft = slice(0,np.searchsorted(krfft[:(s[0]+1)//2],dkr_max))
+        indzfft = slice(0,np.searchsorted(kzfft,dkz_max))
+        fft_ = fft_corr[indrfft,indzfft]
         krfft,kzfft = np.meshgrid(krfft[indrfft],kzfft[indzfft])
 
         if figure:
@@ -349,9 +496,6 @@ class Tools:
             plt.xlabel('$\Delta$ R')
             plt.ylabel('$\Delta$ Z')
 
-            fft_ = fft_corr[indrfft,:]
-            fft_ = fft_[:,indzfft]
-
             fs = 16
             fig = plt.figure()
             #plt.title('FFT of the Correlation')
@@ -396,19 +540,15 @@ class Tools:
         ind = np.abs((self.R - Rref)/Rref) < eps
         N = np.sum(ind)
         print N
-        corr = np.zeros(Nz)
         z = np.linspace(np.min(self.Z[ind]),np.max(self.Z[ind]),Nz)
         Z_temp = self.Z[ind]
         a = Z_temp.argsort()
         Z_temp = Z_temp[a]
         I = self.I[start:,ind][:,a]
-        Igrid = np.zeros((self.Nt-start,Nz))
-        for i in range(self.Nt-start):
-            temp = splrep(Z_temp,I[i,:])
-            Igrid[i,:] = splev(z,temp)
+        # same spline for all the timesteps
+        Igrid = I.dot(spline_matrix(Z_temp,z).T)
 
-        for j in range(Nz):
-            corr[j] = np.corrcoef(Igrid[:,round(index*Nz)],Igrid[:,j])[0,1]
+        corr = correlation_coefficients(Igrid,round(index*Nz))
 
         if not figure:
             return z-z[0],corr,ind
@@ -562,9 +702,7 @@ class Tools:
         a = R_temp.argsort()
         R_temp = R_temp[a]
         I = self.I[:,ind][:,a]
-        corr_ = np.zeros(N)
-        for j in range(N):
-            corr_[j] = np.corrcoef(I[start:,round(index*N)],I[start:,j])[0,1]
+        corr_ = correlation_coefficients(I[start:,:],round(index*N))
 
         temp = splrep(R_temp,corr_)
         corr = splev(r,temp)
@@ -623,18 +761,16 @@ class Tools:
         """
         def autocorrelate(I):
             Nt = I.shape[0]
-            corr = np.zeros(2*Nt-1)
-            for i in range(corr.shape[0]):
-                tau = i-Nt+1
-                N = np.minimum(0,tau)
-                M = np.maximum(Nt,Nt+tau)
-                inda = -N
-                indb = 2*Nt-M
-                indc = M-Nt
-                indd = N+Nt
-                std = np.sum(I[inda:indb]**2)*np.sum(I[indc:indd]**2)
-                corr[i] = np.sum(I[inda:indb]*I[indc:indd])/np.sqrt(std)
-            return corr
+            # number of overlapping points for each shift
+            L = Nt - np.abs(np.arange(1-Nt,Nt))
+            # norms of the overlapping parts (first and last L points)
+            first = np.cumsum(I**2)
+            last = np.cumsum(I[::-1]**2)
+            std = first[L-1]*last[L-1]
+            # the input is real: rfft, with zero padding against the circular aliasing
+            n = next_fast_len(2*Nt-1)
+            corr = irfft(np.abs(rfft(I,n))**2,n)[np.arange(1-Nt,Nt) % n]
+            return corr/np.sqrt(std)
 
         Nt = self.I.shape[0]-start
         corr = np.zeros(Nt)
@@ -747,7 +883,7 @@ def beam_density(t=150):
     bes.beam.compute_beam_on_mesh()
     nb_fl = bes.beam.density_beam
     ne_fl = bes.beam.get_quantities(bes.beam.mesh,t,['ne'],False,check=False)[0]
-    dl = np.sqrt(np.sum((bes.beam.mesh-bes.beam.pos[np.newaxis,:])**2,axis=1))
+    dl = np.linalg.norm(bes.beam.mesh-bes.beam.pos[np.newaxis,:],axis=1)
 
 
     fig, axarr = plt.subplots(2,sharex=True)
@@ -810,7 +946,7 @@ def beam_emission(Nr=40,t=81):
     bes.beam.compute_beam_on_mesh()
 
     r_max = 0.25
-    dl = np.sqrt(np.sum((bes.beam.mesh-bes.beam.pos[np.newaxis,:])**2,axis=1))
+    dl = np.linalg.norm(bes.beam.mesh-bes.beam.pos[np.newaxis,:],axis=1)
     r = np.linspace(-r_max,r_max,Nr)
     R,L = np.meshgrid(r,dl)
     R = R.flatten()
@@ -1,39 +1,116 @@
+import os
 import json
+import stat
+import hashlib
+import tempfile
+from collections import namedtuple
 import scipy.io.netcdf as nc
 import numpy as np
 
 class Diagnoser(object):
 
+    # entries of the diagnostic file used by the Diagnoser
+    _fields = ('npsi', 'ntheta', 'spdim', 'psi_separatrix', 'x', 'z', 'b',
+               'g', 'I', 'q', 'jacobian_boozer', 'jacobian_metric')
+
     def __init__(self, filename='diag_sdp.json'):
 
-        with open(filename) as diagfile:
-            raw_diag = json.load(diagfile)
-        self.npsi = raw_diag['npsi']
-        self.ntheta = raw_diag['ntheta']
-        self.spdim = raw_diag['spdim']
-        self.x = np.array(raw_diag['x']).reshape((self.ntheta, self.npsi,
-                                                  self.spdim))
-        self.z = np.array(raw_diag['z']).reshape((self.ntheta, self.npsi,
-                                                  self.spdim))
-        self.b = np.array(raw_diag['b']).reshape((self.ntheta, self.npsi,
-                                                  self.spdim))
+        raw_diag = self._load(filename)
+        self.npsi = int(raw_diag['npsi'])
+        self.ntheta = int(raw_diag['ntheta'])
+        self.spdim = int(raw_diag['spdim'])
         self.g = np.array(raw_diag['g']).reshape(( self.npsi, 3) )
         self.I = np.array(raw_diag['I']).reshape(( self.npsi, 3) )
         self.q = np.array(raw_diag['q']).reshape(( self.npsi, 3) )
-        self.jacobian_boozer = np.array(raw_diag['jacobian_boozer']).\
-                                       reshape(( self.ntheta, self.npsi, 9) )
-        self.jacobian_metric = np.array(raw_diag['jacobian_metric']).\
-                                       reshape(( self.ntheta, self.npsi, 9) )
+        # coefficients of the 2D splines with the coefficient axis first,
+        # shape (9, ntheta*npsi): each coefficient of the cells is gathered
+        # from its own contiguous plane. The public arrays x, z, b,
+        # jacobian_boozer and jacobian_metric, of shape (ntheta, npsi, 9),
+        # are views of these planes, so the coefficients are stored only once.
+        self._planes = {}
+        for name in ('x', 'z', 'b', 'jacobian_boozer', 'jacobian_metric'):
+            plane = np.ascontiguousarray(np.reshape(raw_diag[name],
+                                         (self.ntheta*self.npsi, -1)).T)
+            self._planes[name] = plane
+            setattr(self, name, plane.T.reshape((self.ntheta, self.npsi, -1)))
         self._dpsi = 1./(self.npsi-1)
         self._dtheta = np.pi*2/(self.ntheta-1)
-        self._psi_separatrix = raw_diag['psi_separatrix']
+        # inverse of the step sizes, used to locate the cells
+        self._inv_dpsi = float(self.npsi-1)
+        self._inv_dtheta = (self.ntheta-1)/(np.pi*2)
+        self._psi_separatrix = float(raw_diag['psi_separatrix'])
+        # the cell indices are stored as int32, the flat cell index must fit
+        assert self.ntheta*self.npsi < 2**31, \
+            "Spline table too large for int32 cell indices"
+
+    def _load(self, filename):
+        """ Read the entries of the diagnostic file as arrays
+
+        Parsing the large float arrays of the JSON file is slow, so the
+        entries are also saved in a binary cache file, *filename* + '.npz'.
+        The cache stores the SHA-1 digest of the JSON content and is only
+        used if it matches the current file. Any error while reading the cache
+        falls back to the JSON file.
+        """
+        with open(filename, 'rb') as diagfile:
+            content = diagfile.read()
+        digest = hashlib.sha1(content).hexdigest()
+        cache = filename + '.npz'
+        if os.path.exists(cache):
+            try:
+                with np.load(cache) as raw_diag:
+                    if str(raw_diag['json_sha1']) == digest:
+                        return dict((name, raw_diag[name])
+                                    for name in self._fields)
+            except Exception:
+                # truncated or foreign file, it is rewritten below
+                pass
+
+        raw_diag = json.loads(content.decode('utf-8'))
+        raw_diag = dict((name, np.array(raw_diag[name]))
+                        for name in self._fields)
+        # the cache gets the read and write permissions of the JSON file
+        self._save_cache(cache, digest, raw_diag,
+                         stat.S_IMODE(os.stat(filename).st_mode) & 0o666)
+        return raw_diag
+
+    @staticmethod
+    def _save_cache(cache, digest, raw_diag, mode):
+        """ Write the cache file atomically
+
+        The arrays are written to a temporary file in the same directory,
+        which is then renamed to *cache*, so an interrupted write never leaves
+        an incomplete cache behind. mkstemp creates the file readable only by
+        its owner, so its permissions are set to *mode* before the rename. The
+        cache is optional: if it can not be written, e.g. in a read only
+        directory, nothing is done.
+        """
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.npz',
+                           dir=os.path.dirname(os.path.abspath(cache)))
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as cachefile:
+                np.savez(cachefile, json_sha1=digest, **raw_diag)
+            os.chmod(tmp, mode)
+            # atomic on POSIX, replaces an existing cache
+            os.rename(tmp, cache)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
 
     def _sp1d(self, psi, ysp):
-        n = np.floor(psi/self._dpsi).astype(np.int)
+        n = np.floor(psi*self._inv_dpsi).astype(np.int32)
         psi_r = psi - n*self._dpsi
         psi_re = psi_r*self._psi_separatrix
 
-        return ysp[n,0] + ysp[n,1]*psi_re + ysp[n, 2]*psi_re*psi_re
+        # gather the 3 coefficients at once (as rows of ysp, faster than the
+        # equivalent fancy indexing) and evaluate in Horner form
+        yn = np.take(ysp, n, axis=0)
+        return yn[..., 0] + psi_re*(yn[..., 1] + psi_re*yn[..., 2])
 
     def g_sp(self, psi):
         return self._sp1d(psi, self.g)
@@ -43,57 +120,139 @@ class Diagnoser(object):
         return self._sp1d(psi, self.q)
 
     def _sp2d(self, psi, theta, ysp):
-        if(np.any(psi>1)):
+        # a single reduction, without boolean temporary of the size of psi
+        if(np.size(psi) and np.max(psi) > 1):
             raise ValueError('psi value greater than 1, outside of plasma \
 boundary. Check psi values, they should be normalized psi_wall.')
         theta = np.remainder(theta, 2*np.pi)
 
-        n = np.floor(psi/self._dpsi).astype(np.int)
+        n = np.floor(psi*self._inv_dpsi).astype(np.int32)
         psi_r = psi - n*self._dpsi
 
         psi_re = psi_r*self._psi_separatrix
 
-        m = np.floor(theta/self._dtheta).astype(np.int)
+        # theta is not negative after the remainder, so the truncation of
+        # the integer conversion is the floor
+        m = (theta*self._inv_dtheta).astype(np.int32)
         theta_re= theta - m*self._dtheta
 
-        psi_re2 = psi_re*psi_re
-        ymn = ysp[m,n,:]
-        return (ymn[..., 0]+ymn[...,1]*psi_re+ymn[...,2]*psi_re2) + \
-               (ymn[...,3]+ymn[...,4]*psi_re+ymn[...,5]*psi_re2)*theta_re +\
-               (ymn[...,6]+ymn[...,7]*psi_re+ymn[...,8]*psi_re2)*theta_re*\
-               theta_re
+        # ysp holds the coefficients with shape (9, ntheta*npsi), each of
+        # them is gathered from its plane, which gives contiguous arrays for
+        # the polynomial evaluation
+        cells = m*self.npsi + n
+        ymn = [np.take(plane, cells) for plane in ysp]
+        # Horner form in theta, each coefficient being a quadratic in psi
+        # also evaluated in Horner form. The result is accumulated in place.
+        y = ymn[6] + psi_re*(ymn[7] + psi_re*ymn[8])
+        y *= theta_re
+        y += ymn[3] + psi_re*(ymn[4] + psi_re*ymn[5])
+        y *= theta_re
+        y += ymn[0] + psi_re*(ymn[1] + psi_re*ymn[2])
+        return y
 
 
     def x_sp(self, psi, theta):
-        return self._sp2d(psi, theta, self.x)
+        return self._sp2d(psi, theta, self._planes['x'])
     def z_sp(self, psi, theta):
-        return self._sp2d(psi, theta, self.z)
+        return self._sp2d(psi, theta, self._planes['z'])
     def b_sp(self, psi, theta):
-        return self._sp2d(psi, theta, self.b)
+        return self._sp2d(psi, theta, self._planes['b'])
     def jm_sp(self, psi, theta):
-        return self._sp2d(psi, theta, self.jacobian_metric)
+        return self._sp2d(psi, theta, self._planes['jacobian_metric'])
     def jb_sp(self, psi, theta):
-        return self._sp2d(psi, theta, self.jacobian_boozer)
+        return self._sp2d(psi, theta, self._planes['jacobian_boozer'])
+
+def _quadratic_basis(x, deriv=False):
+    """ Monomial basis (1, x, x**2) of a quadratic spline along one axis
+
+    :param x: variable array
+    :param bool deriv: if True, the derivative of the basis (0, 1, 2x) is
+                       returned instead
+    :return: array with the shape of x plus a last axis of length 3
+    """
+    x = np.asarray(x, dtype=float)
+    if deriv:
+        return np.stack([np.zeros_like(x), np.ones_like(x), 2*x], axis=-1)
+    return np.stack([np.ones_like(x), x, x*x], axis=-1)
+
+
+# Points located in the cells of a 3D quadratic spline: remainders in each
+# dimension, and the coefficients of the cells with shape (..., 3, 3, 3)
+SplineCache = namedtuple('SplineCache', ['psi_re', 'theta_re', 'zeta_re',
+                                         'coef'])
+
+
+def _sp3d_evaluate(cache, deriv):
+    """ Evaluate a 3D quadratic spline on located points
+
+    The 27 coefficients are ordered as (m, n, p), the powers of zeta_re,
+    theta_re and psi_re respectively. They are contracted one axis at a time
+    with the basis of this axis, so no array of 27 values per point is
+    created for the basis. The powers of each variable are computed only once.
+    """
+    c = np.einsum('...mnp,...p->...mn', cache.coef,
+                  _quadratic_basis(cache.psi_re, deriv == 1))
+    c = np.einsum('...mn,...n->...m', c,
+                  _quadratic_basis(cache.theta_re, deriv == 2))
+    return np.einsum('...m,...m->...', c,
+                     _quadratic_basis(cache.zeta_re, deriv == 3))
+
 
 class AlphaDiagnoser(object):
     """ Diagnoser for magnetic perturbations in GTC obtained from M3DC1"""
 
     def __init__(self, filename='alpha_sdp.nc'):
-        raw_alpha = nc.netcdf_file(filename, 'r')
-        self.npsi = raw_alpha.dimensions['npsi']
-        self.ntheta = raw_alpha.dimensions['ntheta']
-        self.nzeta = raw_alpha.dimensions['nzeta']
-        self._spdim = raw_alpha.dimensions['spdim']
-        self._psi_separatrix = raw_alpha.variables['psi_separatrix'].data
-        self._raw_alpha = raw_alpha.variables['alpha'].data
+        with nc.netcdf_file(filename, 'r', mmap=False) as raw_alpha:
+            self.npsi = raw_alpha.dimensions['npsi']
+            self.ntheta = raw_alpha.dimensions['ntheta']
+            self.nzeta = raw_alpha.dimensions['nzeta']
+            self._spdim = raw_alpha.dimensions['spdim']
+            self._psi_separatrix = np.array(
+                raw_alpha.variables['psi_separatrix'].data, dtype=float)
+            # the coefficients of each cell are kept contiguous (cells are
+            # gathered as rows) and in native byte order: the netcdf data is
+            # big endian, which slows down all the later arithmetic
+            self._raw_alpha = np.ascontiguousarray(
+                raw_alpha.variables['alpha'].data, dtype=float)
         assert self._raw_alpha.shape==(self.nzeta, self.ntheta, self.npsi,
                                          self._spdim)
         assert self._spdim==27, \
             "Quadratic spline is assumed. Other type not implemented"
+        # the cell indices are stored as int32, the flat cell index must fit
+        assert self.nzeta*self.ntheta*self.npsi < 2**31, \
+            "Spline table too large for int32 cell indices"
         # calculate the step sizes in all dimensions
         self._dpsi = 1./(self.npsi-1)
         self._dtheta = np.pi*2/(self.ntheta-1)
         self._dzeta = np.pi*2/(self.nzeta-1)
+        # inverse of the step sizes, used to locate the cells
+        self._inv_dpsi = float(self.npsi-1)
+        self._inv_dtheta = (self.ntheta-1)/(np.pi*2)
+        self._inv_dzeta = (self.nzeta-1)/(np.pi*2)
+
+    def _psi_cell(self, psi):
+        """ Index and remainder of the spline cells in psi """
+        # a single reduction, without boolean temporary of the size of psi
+        if np.size(psi) and np.max(psi) > 1:
+            raise ValueError('psi value greater than 1, outside of plasma \
+boundary. Check psi values, they should be normalized psi_wall.')
+        # note that the GTC spline in done on psi in GTC unit, not normalized
+        # to psiw
+        i = np.floor(psi*self._inv_dpsi).astype(np.int32)
+        psi_r = psi - i*self._dpsi
+        psi_re = psi_r*self._psi_separatrix
+        # special care is needed for i==0 grid, the spline is done with respect
+        # to sqrt(psi) in this cell
+        psi_re = np.where(i == 0, np.sqrt(psi_re), psi_re)
+        return i, psi_re
+
+    def _angle_cell(self, angle, dangle, inv_dangle):
+        """ Index and remainder of the spline cells in theta or zeta """
+        angle = np.remainder(angle, 2*np.pi)
+        # the angle is not negative after the remainder, so the truncation of
+        # the integer conversion is the floor
+        j = (angle*inv_dangle).astype(np.int32)
+        return j, angle - j*dangle
 
     def _sp3d(self, psi, theta, zeta, deriv, ysp):
         """ Evaluate 3D spline function for given derivative
@@ -117,56 +276,60 @@ class AlphaDiagnoser(object):
         """
         if deriv > 3 or deriv < 0:
             raise ValueError('Wrong derivative flag: {0}'.format(deriv))
-        if np.any(psi > 1):
-            raise ValueError('psi value greater than 1, outside of plasma \
-boundary. Check psi values, they should be normalized psi_wall.')
-        theta = np.remainder(theta, 2*np.pi)
-        zeta = np.remainder(zeta, 2*np.pi)
+        return _sp3d_evaluate(self._locate(psi, theta, zeta, ysp), deriv)
 
-        # obtain index and remainder in psi
-        # note that the GTC spline in done on psi in GTC unit, not normalized
-        # to psiw
-        i = np.floor(psi/self._dpsi).astype(np.int)
-        psi_r = psi - i*self._dpsi
-        psi_re = psi_r*self._psi_separatrix
-        # special care is needed for i==0 grid, the spline is done with respect
-        # to sqrt(psi) in this cell
-        psi_re = np.where(i == 0, np.sqrt(psi_re), psi_re)
+    def _locate(self, psi, theta, zeta, ysp):
+        """ Locate the points in the spline cells and gather the coefficients
 
-        # obtain index and remainder in theta
-        j = np.floor(theta/self._dtheta).astype(np.int)
-        theta_re = theta - j*self._dtheta
-
-        # obtain index and remainder in theta
-        k = np.floor(zeta/self._dzeta).astype(np.int)
-        zeta_re = zeta - k*self._dzeta
-
-        # create the 3D spline vector
-        if deriv == 0:
-            dx_vec = np.transpose([psi_re**p*theta_re**n*zeta_re**m for m in range(3)
-                                   for n in range(3) for p in range(3)], (1, 2, 3, 0))
-        elif deriv == 1:
-            dx_vec = np.transpose([p*psi_re**(max(0, p-1))*\
-                                   theta_re**n*zeta_re**m for m in range(3)
-                                   for n in range(3) for p in range(3)], (1, 2, 3, 0))
-        elif deriv == 2:
-            dx_vec = np.transpose([psi_re**p*n*theta_re**(max(0, n-1))*\
-                                   zeta_re**m for m in range(3)
-                                   for n in range(3) for p in range(3)], (1, 2, 3, 0))
-        elif deriv == 3:
-            dx_vec = np.transpose([psi_re**p*theta_re**n*\
-                                   m*zeta_re**(max(0,m-1)) for m in range(3)
-                                   for n in range(3) for p in range(3)], (1, 2, 3, 0))
-        else:
-            raise ValueError('Wrong derivative flag: {0}'.format(deriv))
+        :return: the remainders and the coefficients of the cells
+        :rtype: :class:`SplineCache`
+        """
+        i, psi_re = self._psi_cell(psi)
+        j, theta_re = self._angle_cell(theta, self._dtheta, self._inv_dtheta)
+        k, zeta_re = self._angle_cell(zeta, self._dzeta, self._inv_dzeta)
+        return SplineCache(psi_re, theta_re, zeta_re,
+                           self._gather(ysp, k, j, i))
 
+    def _gather(self, ysp, k, j, i):
+        """ Coefficients of the cells (k, j, i), with shape (..., 3, 3, 3)
 
-        return np.sum(ysp[k, j, i, :]*dx_vec, axis=-1)
+        The cells are taken as rows of the flattened coefficient array, which
+        is faster than the equivalent fancy indexing ysp[k, j, i, :].
+        """
+        nzeta, ntheta, npsi, spdim = ysp.shape
+        cells = (k*ntheta + j)*npsi + i
+        c = np.take(ysp.reshape(-1, spdim), cells, axis=0)
+        return c.reshape(c.shape[:-1] + (3, 3, 3))
 
     def alpha_sp(self, psi, theta, zeta, deriv=0):
         """evaluate alpha using GTC spline coefficients"""
         return self._sp3d(psi, theta, zeta, deriv, self._raw_alpha)
 
+    def prepare(self, psi, theta, zeta):
+        """ Locate the points for repeated evaluations of alpha
+
+        The cell indices, remainders and spline coefficients are computed only
+        once, then :meth:`alpha_sp_cached` evaluates alpha or its derivatives
+        on these points without locating them again.
+
+        :param psi: psi value array
+        :param theta: theta value array
+        :param zeta: zeta value array
+        :rtype: :class:`SplineCache`
+        """
+        return self._locate(psi, theta, zeta, self._raw_alpha)
+
+    def alpha_sp_cached(self, cache, deriv=0):
+        """ Evaluate alpha on points located by :meth:`prepare`
+
+        :param cache: located points returned by :meth:`prepare`
+        :type cache: :class:`SplineCache`
+        :param int deriv: derivative flag, see :meth:`_sp3d`
+        """
+        if deriv > 3 or deriv < 0:
+            raise ValueError('Wrong derivative flag: {0}'.format(deriv))
+        return _sp3d_evaluate(cache, deriv)
+
     def fourier_analysis(self, psi, ntheta, nzeta):
         """ Evaluate alpha_mn(psi) based on the GTC alpha spline
 
@@ -182,22 +345,31 @@ boundary. Check psi values, they should be normalized psi_wall.')
         theta_1d = np.linspace(0, 2*np.pi, ntheta)[0:-1]
         zeta_1d = np.linspace(0, 2*np.pi, nzeta)[0:-1]
 
-        zeta_mesh, theta_mesh, psi_mesh = np.meshgrid(zeta_1d, theta_1d,
-                                                      psi_1d, indexing='ij')
         # spline interpolate the alpha values on 3D mesh
-        alpha_arr = self.alpha_sp(psi_mesh, theta_mesh, zeta_mesh)
+        # the mesh is a tensor product of 1D grids, so the cells and the
+        # monomial basis are computed on each 1D grid, and the coefficients
+        # gathered on the mesh are contracted with these 1D bases
+        i, psi_re = self._psi_cell(np.atleast_1d(psi_1d))
+        j, theta_re = self._angle_cell(theta_1d, self._dtheta,
+                                       self._inv_dtheta)
+        k, zeta_re = self._angle_cell(zeta_1d, self._dzeta,
+                                      self._inv_dzeta)
+        c = self._gather(self._raw_alpha, k[:, np.newaxis, np.newaxis],
+                         j[np.newaxis, :, np.newaxis],
+                         i[np.newaxis, np.newaxis, :])
+        c = np.einsum('ztimnp,ip->ztimn', c, _quadratic_basis(psi_re))
+        c = np.einsum('ztimn,tn->ztim', c, _quadratic_basis(theta_re))
+        alpha_arr = np.einsum('ztim,zm->zti', c, _quadratic_basis(zeta_re))
         # Calculate the Harmonics
         # Note that the convention was alpha = sum alpha_mn*exp(in zeta-im theta)
         # So the inversed relation is alpha_mn = 1/mn sum alpha*exp(-in zeta +
         # im theta)
         alpha_m = np.fft.fft(alpha_arr,axis=1,norm=None)/ntheta
         # the np.fft.fft convention has the opposite sign for theta, we need to
-        # revert the m harmonics, first shift the array to have increasing
-        # order
-        alpha_m = np.fft.fftshift(alpha_m, axes=1)
-        # revert the whole array
-        alpha_m = np.flip(alpha_m, axis=1)
-        # shift back to FFT order, mtheta is assumed odd
-        alpha_m = np.fft.ifftshift(alpha_m, axes=1)
+        # revert the m harmonics. The number of theta points ntheta-1 is odd,
+        # so in FFT order the harmonic m is moved to the index -m, which is
+        # done in a single gather
+        mtheta = alpha_m.shape[1]
+        alpha_m = np.take(alpha_m, -np.arange(mtheta) % mtheta, axis=1)
         # normal FFT on zeta and return
         return np.fft.fft(alpha_m, axis=0,norm=None)/nzeta
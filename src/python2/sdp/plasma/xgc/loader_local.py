@@ -17,6 +17,8 @@ import numpy as np
 import h5py as h5
 from scipy.interpolate import splrep, splev
 from scipy.interpolate import LinearNDInterpolator, CloughTocher2DInterpolator
+from scipy.interpolate import RegularGridInterpolator
+from scipy.spatial import Delaunay
 from loader import load_m, XGC_Loader_Error
 from sdp.math.rungekutta import runge_kutta_explicit
 
@@ -47,15 +49,97 @@ def get_interp_planes_local(my_xgc,phi3D):
         nextplane = np.searchsorted(phi_planes,temp,side = 'right')
         prevplane = nextplane - 1
         # change the highest value for the periodicity
-        nextplane[np.nonzero(nextplane == my_xgc.n_plane)] = 0
+        nextplane %= my_xgc.n_plane
     else:
         prevplane = np.searchsorted(phi_planes,temp,side = 'right')
         nextplane = prevplane - 1
-        prevplane[np.nonzero(prevplane == my_xgc.n_plane)] = 0
+        prevplane %= my_xgc.n_plane
 
     return (prevplane,nextplane)
 
 
+class GridInterpolator(RegularGridInterpolator):
+    """Linear interpolant on a regular (R,Z) grid that can be called as the
+    interpolants on the XGC mesh (with f(R,Z) or f(points)).
+
+    The grid cells that are not entirely inside the XGC mesh would blend the
+    values inside the mesh with the fill value. The points in these cells (and
+    outside the grid) are evaluated with the interpolant on the mesh instead,
+    so the results are finite everywhere inside the mesh.
+
+    :param (np.array[NR],np.array[NZ]) grid: Regularly spaced R and Z of the grid
+    :param np.array[NR,NZ,...] values: Values on the grid
+    :param fallback: Interpolant on the mesh (called with f(R,Z))
+    :param np.array[NR-1,NZ-1] cell_inside: True for the cells with the 4 corners inside the mesh
+    """
+
+    def __init__(self,grid,values,fallback,cell_inside,**kwargs):
+        RegularGridInterpolator.__init__(self,grid,values,**kwargs)
+        self.fallback = fallback
+        self.cell_inside = cell_inside
+        self._origin = np.array([grid[0][0],grid[1][0]])
+        self._inv_step = np.array([(len(grid[0])-1)/(grid[0][-1]-grid[0][0]),
+                                   (len(grid[1])-1)/(grid[1][-1]-grid[1][0])])
+
+    def __call__(self,*xi):
+        if len(xi) == 1:
+            pts = np.asarray(xi[0])
+        else:
+            R,Z = np.broadcast_arrays(*xi)
+            pts = np.stack((R,Z),axis=-1)
+        values = RegularGridInterpolator.__call__(self,pts)
+
+        # cell of each point, the points outside the grid use the fallback
+        x = (pts-self._origin)*self._inv_step
+        exact = np.all((x >= 0) & (x < np.array(self.cell_inside.shape)),axis=-1)
+        i = np.where(exact,x[...,0],0).astype(int)
+        j = np.where(exact,x[...,1],0).astype(int)
+        exact &= self.cell_inside[i,j]
+        if not np.all(exact):
+            out = ~exact
+            values[out] = self.fallback(pts[...,0][out],pts[...,1][out])
+        return values
+
+
+def sample_on_grid(interp,points,shape,fill_value):
+    """Sample an interpolant on a regular grid covering some points.
+
+    The interpolant on the mesh is kept for the grid cells crossing the
+    boundary of the mesh, see :class:`GridInterpolator`.
+
+    :param interp: Interpolant on the mesh (called with f(R,Z), with a ``tri`` triangulation attribute)
+    :param np.array[N,2] points: (R,Z) points defining the extent of the grid
+    :param (int,int) shape: Number of points of the grid in R and Z
+    :param float fill_value: Value outside the grid
+
+    :returns: Linear interpolant on the grid
+    :rtype: :class:`GridInterpolator`
+    """
+    R = np.linspace(np.min(points[:,0]),np.max(points[:,0]),shape[0])
+    Z = np.linspace(np.min(points[:,1]),np.max(points[:,1]),shape[1])
+    Rgrid, Zgrid = np.meshgrid(R,Z,indexing='ij')
+    inside = interp.tri.find_simplex(np.stack((Rgrid,Zgrid),axis=-1)) >= 0
+    cell_inside = inside[:-1,:-1] & inside[1:,:-1] & inside[:-1,1:] & inside[1:,1:]
+    return GridInterpolator((R,Z), interp(Rgrid,Zgrid), interp, cell_inside,
+                            bounds_error=False, fill_value=fill_value)
+
+
+def group_by_plane(plane,planes):
+    """Group the points by plane with a single sort (instead of a search for each plane).
+
+    :param np.array[N] plane: Plane of each point
+    :param np.array[M] planes: Sorted planes
+
+    :returns: Indices (in increasing order) of the points using each plane
+    :rtype: list[np.array]
+    """
+    order = np.argsort(plane,kind='mergesort')
+    plane = plane[order]
+    start = np.searchsorted(plane,planes,side='left')
+    end = np.searchsorted(plane,planes,side='right')
+    return [order[i:j] for i,j in zip(start,end)]
+
+
 class XGC_Loader_local():
     """Loader classe for a local diagnostics and without a grid.
 
@@ -82,11 +166,18 @@ class XGC_Loader_local():
     :param float shift: Shift for phi (default value assumed that plane number 0 is at phi=0)
     :param str kind: Order of the interpolation method (linear or cubic))
     :param int plane: Index of the plane where the shift needs to be done
+    :param (int,int) B_grid: If given, the magnetic field is sampled once on a regular (R,Z) grid of this size\
+    and linearly interpolated on it during the field line integration. It is much faster than the interpolation on\
+    the XGC mesh, but less accurate (None for using directly the XGC mesh)
+    :param (int,int) psi_grid: Same as B_grid, but for psi
+    :param np.dtype dtype: Type used for storing the fluctuations (potential and density). By default, the type\
+    of the XGC files is kept. np.float32 halves the memory used by the fluctuations, at the cost of single precision values
 
     For more detail about the shift, look at the code in :func:`get_interp_planes_local <sdp.plasma.xgc.load_XGC_local.get_interp_planes_local>`
     """
 
-    def __init__(self,xgc_path,t_start,t_end,dt,limits,dphi,shift=0,kind='linear',plane=0):
+    def __init__(self,xgc_path,t_start,t_end,dt,limits,dphi,shift=0,kind='linear',plane=0,B_grid=None,psi_grid=None,
+                 dtype=None):
         """Copy all the input values and call all the functions that compute the equilibrium and the first
         time step.
         """
@@ -102,6 +193,9 @@ class XGC_Loader_local():
         self.ne_input_file = xgc_path+'ne_input.in'
         self.shift = shift
         self.kind = kind
+        self.B_grid = B_grid
+        self.psi_grid = psi_grid
+        self.dtype = dtype
 
         print 'from directory:'+ self.xgc_path
         self.unit_dic = load_m(self.unit_file)
@@ -192,26 +286,31 @@ class XGC_Loader_local():
         """
         # open the file
         mesh = h5.File(self.mesh_file,'r')
-        RZ = mesh['coordinates']['values']
-        Rpts =RZ[:,0]
+        # the datasets are read once into C-contiguous arrays
+        self.points = np.ascontiguousarray(mesh['coordinates']['values'][...])
+        Rpts = self.points[:,0]
 
-        Zpts = RZ[:,1]
+        Zpts = self.points[:,1]
 
-        psi = mesh['psi']
+        psi = mesh['psi'][...]
+        # triangulation of the mesh, shared by the interpolants of psi and B
+        self.Delaunay = Delaunay(self.points)
         # psi interpolant
         fill_ = np.nan
         if not self.lim:
-            fill_ = max(psi)
+            fill_ = np.max(psi)
         if self.kind == 'linear':
             self.psi_interp = LinearNDInterpolator(
-                np.array([Rpts,Zpts]).T, psi, fill_value=fill_)
+                self.Delaunay, psi, fill_value=fill_)
         elif self.kind == 'cubic':
             self.psi_interp = CloughTocher2DInterpolator(
-                np.array([Rpts,Zpts]).T, psi, fill_value=fill_)
+                self.Delaunay, psi, fill_value=fill_)
         else:
             raise NameError("The method '{}' is not defined".format(self.kind))
 
-        self.points = np.array([Rpts,Zpts]).transpose()
+        if self.psi_grid is not None:
+            # psi does not depend on time, it is sampled once on a regular grid
+            self.psi_interp = sample_on_grid(self.psi_interp,self.points,self.psi_grid,fill_)
 
         if self.lim:
             # 0.99 and 1.01 are for increasing the window in order to take the last point
@@ -237,7 +336,7 @@ class XGC_Loader_local():
         Compute the limits by taking into account the field line interpolation
         """
         B_mesh = h5.File(self.bfield_file,'r')
-        B = B_mesh['node_data[0]']['values']
+        B = B_mesh['node_data[0]']['values'][...]
         # keep only the values around the diagnostics
 
         # interpolant of each direction of the field
@@ -245,12 +344,18 @@ class XGC_Loader_local():
         # deal with them later in interpolation function
         if self.kind == 'linear':
             self.B_interp = LinearNDInterpolator(
-                self.points, B, fill_value = np.inf)
+                self.Delaunay, B, fill_value = np.inf)
         elif self.kind == 'cubic':
             self.B_interp =  CloughTocher2DInterpolator(
-                self.points, B, fill_value = np.inf)
+                self.Delaunay, B, fill_value = np.inf)
         else:
             raise NameError("The method '{}' is not defined".format(self.kind))
+
+        if self.B_grid is not None:
+            # sample the field on a regular grid covering the mesh,
+            # the points outside the mesh keep the flag np.inf
+            self.B_interp = sample_on_grid(self.B_interp,self.points,self.B_grid,np.inf)
+
         self.fill_Bphi = np.sign(B[0,2])*np.min(np.absolute(B[:,2]))
 
         #If toroidal B field is positive, then field line is going in
@@ -289,6 +394,8 @@ class XGC_Loader_local():
             # remove the points outside the window
             self.ind = (self.points[:,0] > self.Rmin) & (self.points[:,0] < self.Rmax)
             self.ind = self.ind & (self.points[:,1] > self.Zmin) & (self.points[:,1] < self.Zmax)
+            if not np.any(self.ind):
+                raise XGC_Loader_Error('No mesh node inside the window of the diagnostic')
             self.points = self.points[self.ind,:]
             print 'Keep: ',str(self.points.shape[0]),'Points on a total of: '\
                 ,str(self.ind.shape[0])
@@ -296,6 +403,10 @@ class XGC_Loader_local():
 
             print 'Zlimits: [',np.min(self.points[:,1]),np.max(self.points[:,1]),']'
             print 'Rlimits: [',np.min(self.points[:,0]),np.max(self.points[:,0]),']'
+
+            # the points do not change anymore, the triangulation is shared by the
+            # interpolants of all the planes and time steps
+            self.Delaunay = Delaunay(self.points)
         return 0
 
 
@@ -316,28 +427,43 @@ class XGC_Loader_local():
         #the dictionary contains the positions of each chosen plane,
         # useful when we want to get the data on a given plane known only its plane number in xgc file.
         # the last dimension is for the mesh position
-        self.nane = np.zeros( (len(self.planes),
-                               len(self.points[:,0])) )
-
-        self.phi = np.zeros( (len(self.planes),
-                              len(self.points[:,0])) )
-
         flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[self.current]).zfill(5)+'.h5'
         fluc_mesh = h5.File(flucf,'r')
 
+        # the nodes inside the window are read as contiguous runs of rows
+        # (instead of a point selection in the file), so only the rows of the
+        # window are read
+        planes = (self.planes)%self.n_plane
         if self.lim:
-            self.phi += np.swapaxes(
-                fluc_mesh['dpot'][self.ind,:][:,(self.planes)%self.n_plane],0,1)
-
-            self.nane += np.swapaxes(
-                fluc_mesh['eden'][self.ind,:][:,(self.planes)%self.n_plane],0,1)
-
+            nodes = np.nonzero(self.ind)[0]
+            # first and last+1 node of each run of consecutive nodes
+            breaks = np.nonzero(np.diff(nodes) != 1)[0] + 1
+            runs = list(zip(nodes[np.r_[0,breaks]],nodes[np.r_[breaks-1,len(nodes)-1]]+1))
+            n_nodes = len(nodes)
         else:
-            self.phi += np.swapaxes(
-                fluc_mesh['dpot'][:,:][:,(self.planes)%self.n_plane],0,1)
-
-            self.nane += np.swapaxes(
-                fluc_mesh['eden'][:,:][:,(self.planes)%self.n_plane],0,1)
+            n_nodes = fluc_mesh['dpot'].shape[0]
+            runs = [(0,n_nodes)]
+
+        def read_planes(dset):
+            dtype = dset.dtype if self.dtype is None else self.dtype
+            data = np.empty((len(planes),n_nodes),dtype=dtype)
+            # position of the run in the array of the kept nodes
+            k = 0
+            for start,stop in runs:
+                n = stop - start
+                if len(planes) < self.n_plane:
+                    # only a subset of the planes is needed: each plane is
+                    # read on its own, so the other planes are not read
+                    for j,p in enumerate(planes):
+                        data[j,k:k+n] = dset[start:stop,p]
+                else:
+                    data[:,k:k+n] = dset[start:stop,:].T[planes]
+                k += n
+            return data
+
+        self.phi = read_planes(fluc_mesh['dpot'])
+
+        self.nane = read_planes(fluc_mesh['eden'])
 
         fluc_mesh.close()
 
@@ -347,17 +473,19 @@ class XGC_Loader_local():
         """Load equilibrium profiles and compute the interpolant
         """
         eqf = self.xgc_path + 'xgc.oneddiag.h5'
-        eq_mesh = h5.File(eqf,'r')
-        eq_psi = eq_mesh['psi_mks'][:]
-        self.psi_x = load_m(self.xgc_path + 'units.m')['psi_x']
-        #sometimes eq_psi is stored as 2D array, which has time series infomation.
-        # For now, just use the time step 1 psi array as the unchanged array.
-        # NEED TO BE CHANGED if equilibrium psi mesh is changing over time.
-        n_psi = eq_psi.shape[-1]
-        eq_psi = eq_psi.flatten()[0:n_psi] #pick up the first n psi values.
-
-        eq_ti = eq_mesh['i_perp_temperature_1d'][0,:]
-        eq_ni = eq_mesh['i_gc_density_1d'][0,:]
+        self.psi_x = self.unit_dic['psi_x']
+        # read all the profiles at once and close the file right away
+        with h5.File(eqf,'r') as eq_mesh:
+            #sometimes eq_psi is stored as 2D array, which has time series infomation.
+            # For now, just use the time step 1 psi array as the unchanged array.
+            # NEED TO BE CHANGED if equilibrium psi mesh is changing over time.
+            eq_psi = eq_mesh['psi_mks']
+            eq_psi = eq_psi[0] if eq_psi.ndim > 1 else eq_psi[:] #pick up the first n psi values.
+            eq_ti = eq_mesh['i_perp_temperature_1d'][0,:]
+            eq_ni = eq_mesh['i_gc_density_1d'][0,:]
+            eq_te = eq_mesh['e_perp_temperature_1d'][0,:]
+            eq_ne = eq_mesh['e_gc_density_1d'][0,:]
+
         self.ni_min = np.min(eq_ni)
         self.ti_min = np.min(eq_ti)
 
@@ -365,15 +493,11 @@ class XGC_Loader_local():
         self.ti0_sp = splrep(eq_psi,eq_ti,k=1)
         self.ni0_sp = splrep(eq_psi,eq_ni,k=1)
         #simulation has electron dynamics
-        eq_te = eq_mesh['e_perp_temperature_1d'][0,:]
-        eq_ne = eq_mesh['e_gc_density_1d'][0,:]
         self.te_min = np.min(eq_te)
         self.ne_min = np.min(eq_ne)
         self.te0_sp = splrep(eq_psi,eq_te,k=1)
         self.ne0_sp = splrep(eq_psi,eq_ne,k=1)
 
-        eq_mesh.close()
-
     def calc_total_ne_3D(self,psi,nane,pot):
         """Calculate the total electron at the wanted points.
 
@@ -392,38 +516,41 @@ class XGC_Loader_local():
         ne0 = splev(psi,self.ne0_sp)
         ne0[ne0<self.ne_min/10] = self.ne_min/10
 
-        dne_ad = np.zeros(pot.shape)
-        dne_ad += ne0*pot/te0
-        ind = np.isfinite(dne_ad)
-        ad_valid_idx = np.zeros(dne_ad.shape,dtype=bool)
-        ad_valid_idx[ind] = np.absolute(dne_ad[ind])<= np.absolute(ne0[ind])
-
-        ne = np.zeros(pot.shape)
-        ne += ne0[:]
-        ne[ad_valid_idx] += dne_ad[ad_valid_idx]
-        ind2 = np.isfinite(nane)
-        na_valid_idx = np.zeros(nane.shape,dtype=bool)
-        na_valid_idx[ind2] = np.absolute(nane[ind2])<= np.absolute(ne[ind2])
-        ne[na_valid_idx] += nane[na_valid_idx]
-        ne[~ind | ~ind2] = ne0[~ind | ~ind2]
+        dne_ad = ne0*pot/te0
+        # the fluctuations are added only if they are smaller than the density
+        # (the comparisons are False for the non finite values)
+        with np.errstate(invalid='ignore'):
+            ne = ne0 + np.where(np.absolute(dne_ad) <= np.absolute(ne0),dne_ad,0.0)
+            ne += np.where(np.absolute(nane) <= np.absolute(ne),nane,0.0)
+        # keep the equilibrium if one of the fluctuations is not valid
+        ind = ~(np.isfinite(dne_ad) & np.isfinite(nane))
+        ne[ind] = ne0[ind]
         return ne
 
     def compute_interpolant(self):
-        """ Compute the interpolant for the ion and electron
-            density
+        """ Reset the interpolant for the ion and electron
+            density. They are computed only when needed (see :func:`get_interpolant`)
+        """
+        if self.kind not in ['linear','cubic']:
+            raise NameError("The method '{}' is not defined".format(self.kind))
+        # list of interpolant (None if not computed yet)
+        self.interpfluc = [None]*len(self.planes)
+
+    def get_interpolant(self,j):
+        """ Give the interpolant of the potential and the non-adiabatic density on a plane.
+        It is computed at the first call after each time step.
+
+        :param int j: Index of the plane (in self.planes)
         """
-        # list of interpolant
-        self.interpfluc = []
-        for j in range(len(self.planes)):
+        if self.interpfluc[j] is None:
             # computation of interpolant
             if self.kind == 'linear':
-                self.interpfluc.append(
-                    LinearNDInterpolator(self.points,np.array([self.phi[j,:],self.nane[j,:]]).T,fill_value=np.nan))
-            elif self.kind == 'cubic':
-                self.interpfluc.append(
-                    CloughTocher2DInterpolator(self.points,np.array([self.phi[j,:],self.nane[j,:]]).T,fill_value=np.nan))
+                self.interpfluc[j] = LinearNDInterpolator(
+                    self.Delaunay,np.array([self.phi[j,:],self.nane[j,:]]).T,fill_value=np.nan)
             else:
-                raise NameError("The method '{}' is not defined".format(self.kind))
+                self.interpfluc[j] = CloughTocher2DInterpolator(
+                    self.Delaunay,np.array([self.phi[j,:],self.nane[j,:]]).T,fill_value=np.nan)
+        return self.interpfluc[j]
 
 
     def find_interp_positions(self,r,z,phi,prev_,next_):
@@ -492,25 +619,31 @@ class XGC_Loader_local():
             step[np.abs(step) > self.dphi] = sign*self.dphi
             # update the position of the next iteration
             phiFWD[ind] -= step
-            K = np.zeros((r[ind].shape[0],3,Nstage))
+            R0 = R_FWD[ind]
+            Z0 = Z_FWD[ind]
+            K = np.zeros((R0.shape[0],3,Nstage))
             for i in range(Nstage):
                 # compute the coordinates of this stage
-                Rtemp = R_FWD[ind] + step*np.sum(a[i,:i]*K[:,0,:i],axis=1)
-                Ztemp = Z_FWD[ind] + step*np.sum(a[i,:i]*K[:,1,:i],axis=1)
-                Btemp = self.B_interp(Rtemp,Ztemp)
+                Rtemp = R0 + step*K[:,0,:i].dot(a[i,:i])
+                Ztemp = Z0 + step*K[:,1,:i].dot(a[i,:i])
+                Btemp = self.B_interp(np.column_stack((Rtemp,Ztemp)))
                 # avoid the part outside the mesh
                 indinf = np.isfinite(Btemp[:,2])
+                Rtemp = Rtemp[indinf]
+                Btemp = Btemp[indinf,:]
 
                 # evaluate the function
-                K[indinf,0,i] = Rtemp[indinf] * Btemp[indinf,0] / Btemp[indinf,2]
-                K[indinf,1,i] = Rtemp[indinf] * Btemp[indinf,1] / Btemp[indinf,2]
-                K[indinf,2,i] = np.sqrt(Rtemp[indinf]**2 + K[indinf,0,i]**2 + K[indinf,1,i]**2)
-
+                KR = Rtemp * Btemp[:,0] / Btemp[:,2]
+                KZ = Rtemp * Btemp[:,1] / Btemp[:,2]
+                K[indinf,0,i] = KR
+                K[indinf,1,i] = KZ
+                K[indinf,2,i] = np.sqrt(Rtemp**2 + KR**2 + KZ**2)
 
             # compute the final value of this step
-            dR_FWD = step*np.sum(b[np.newaxis,:]*K[:,0,:],axis=1)
-            dZ_FWD = step*np.sum(b[np.newaxis,:]*K[:,1,:],axis=1)
-            ds_FWD = np.abs(step)*np.sum(b[np.newaxis,:]*K[:,2,:],axis=1)
+            Kb = K.dot(b)
+            dR_FWD = step*Kb[:,0]
+            dZ_FWD = step*Kb[:,1]
+            ds_FWD = np.abs(step)*Kb[:,2]
 
             #when the point gets outside of the XGC mesh, set BR,BZ to zero.
             dR_FWD[~np.isfinite(dR_FWD)] = 0.0
@@ -535,24 +668,31 @@ class XGC_Loader_local():
             step[np.abs(step) > self.dphi] = sign*self.dphi
             # update the position of the next iteration
             phiBWD[ind] -= step
-            K = np.zeros((r[ind].shape[0],3,Nstage))
+            R0 = R_BWD[ind]
+            Z0 = Z_BWD[ind]
+            K = np.zeros((R0.shape[0],3,Nstage))
             for i in range(Nstage):
                 # compute the coordinates of this stage
-                Rtemp = R_BWD[ind] + step*np.sum(a[i,:i]*K[:,0,:i],axis=1)
-                Ztemp = Z_BWD[ind] + step*np.sum(a[i,:i]*K[:,1,:i],axis=1)
-                Btemp = self.B_interp(Rtemp,Ztemp)
+                Rtemp = R0 + step*K[:,0,:i].dot(a[i,:i])
+                Ztemp = Z0 + step*K[:,1,:i].dot(a[i,:i])
+                Btemp = self.B_interp(np.column_stack((Rtemp,Ztemp)))
+                # avoid the part outside the mesh
                 indinf = np.isfinite(Btemp[:,2])
-                # evaluate the function
-
-                K[indinf,0,i] = Rtemp[indinf] * Btemp[indinf,0] / Btemp[indinf,2]
-                K[indinf,1,i] = Rtemp[indinf] * Btemp[indinf,1] / Btemp[indinf,2]
-                K[indinf,2,i] = np.sqrt(Rtemp[indinf]**2 + K[indinf,0,i]**2 + K[indinf,1,i]**2)
+                Rtemp = Rtemp[indinf]
+                Btemp = Btemp[indinf,:]
 
+                # evaluate the function
+                KR = Rtemp * Btemp[:,0] / Btemp[:,2]
+                KZ = Rtemp * Btemp[:,1] / Btemp[:,2]
+                K[indinf,0,i] = KR
+                K[indinf,1,i] = KZ
+                K[indinf,2,i] = np.sqrt(Rtemp**2 + KR**2 + KZ**2)
 
             # compute the final value of this step
-            dR_BWD = step*np.sum(b[np.newaxis,:]*K[:,0,:],axis=1)
-            dZ_BWD = step*np.sum(b[np.newaxis,:]*K[:,1,:],axis=1)
-            ds_BWD = np.abs(step)*np.sum(b[np.newaxis,:]*K[:,2,:],axis=1)
+            Kb = K.dot(b)
+            dR_BWD = step*Kb[:,0]
+            dZ_BWD = step*Kb[:,1]
+            ds_BWD = np.abs(step)*Kb[:,2]
 
             #when the point gets outside of the XGC mesh, set BR,BZ to zero.
             dR_BWD[~np.isfinite(dR_BWD)] = 0.0
@@ -631,37 +771,37 @@ class XGC_Loader_local():
             if ne_bool:
                 ne = np.zeros(r.shape[0])
                 interp_positions = self.find_interp_positions(r,z,phi,prevplane,nextplane)
+                # contiguous views on the positions (R,Z) and distances (L) for the previous/next plane
+                (R_prev,Z_prev,L_prev),(R_next,Z_next,L_next) = interp_positions
                 if self.lim:
-                    ind = (self.Zmax > interp_positions[0,1]) & (interp_positions[0,1] > self.Zmin)
-                    ind = ind & ((self.Zmax > interp_positions[1,1]) & (interp_positions[1,1] > self.Zmin))
-                    ind = ind & (self.Rmax > interp_positions[0,0]) & (interp_positions[0,0] > self.Rmin)
-                    ind = ind & (self.Rmax > interp_positions[1,0]) & (interp_positions[1,0] > self.Rmin)
-
-                #create index dictionary, for each key as plane number and
-                # value the corresponding indices where the plane is used as previous or next plane.
-                prev_idx = {}
-                next_idx = {}
-                for j in range(len(self.planes)):
-                    prev_idx[j] = np.where(prevplane == self.planes[j] )
-                    next_idx[j] = np.where(nextplane == self.planes[j] )
+                    ind = (self.Zmax > Z_prev) & (Z_prev > self.Zmin)
+                    ind = ind & ((self.Zmax > Z_next) & (Z_next > self.Zmin))
+                    ind = ind & (self.Rmax > R_prev) & (R_prev > self.Rmin)
+                    ind = ind & (self.Rmax > R_next) & (R_next > self.Rmin)
+
+                # indices where each plane is used as previous or next plane.
+                prev_idx = group_by_plane(prevplane,self.planes)
+                next_idx = group_by_plane(nextplane,self.planes)
 
                 #for each time step, first create the 2 arrays of quantities for interpolation
                 prevn = np.zeros((r.shape[0],2))
                 nextn = np.zeros((prevn.shape[0],2))
 
                 for j in range(len(self.planes)):
-                    # interpolation on the poloidal planes
-                    prevn[prev_idx[j]] = self.interpfluc[j](
-                        interp_positions[0,0][prev_idx[j]], interp_positions[0,1][prev_idx[j]])
-
-                    nextn[next_idx[j]] = self.interpfluc[j](
-                        interp_positions[1,0][next_idx[j]], interp_positions[1,1][next_idx[j]])
+                    # interpolation on the poloidal planes (only on the planes used)
+                    if len(prev_idx[j]) > 0:
+                        prevn[prev_idx[j]] = self.get_interpolant(j)(
+                            R_prev[prev_idx[j]], Z_prev[prev_idx[j]])
+
+                    if len(next_idx[j]) > 0:
+                        nextn[next_idx[j]] = self.get_interpolant(j)(
+                            R_next[next_idx[j]], Z_next[next_idx[j]])
                 # interpolation along the field line
-                phi_pot = prevn[:,0] * interp_positions[1,2,...] + nextn[:,0] * interp_positions[0,2,...]
-                ne = prevn[:,1] * interp_positions[1,2,...] + nextn[:,1] * interp_positions[0,2,...]
-                psi = self.psi_interp(interp_positions[0,0,...],interp_positions[0,1,...])
-                psin= self.psi_interp(interp_positions[1,0,...],interp_positions[1,1,...])
-                psi = psin * interp_positions[1,2,...] + psi * interp_positions[0,2,...]
+                phi_pot = prevn[:,0] * L_next + nextn[:,0] * L_prev
+                ne = prevn[:,1] * L_next + nextn[:,1] * L_prev
+                psi = self.psi_interp(R_prev,Z_prev)
+                psin= self.psi_interp(R_next,Z_next)
+                psi = psin * L_next + psi * L_prev
                 ne = self.calc_total_ne_3D(psi,ne,phi_pot)
 
                 if self.lim:
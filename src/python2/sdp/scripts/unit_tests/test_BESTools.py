@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+test sdp.diagnostic.bes.tools
+
+The vectorized computations are compared with the original formulas.
+
+Unlike the other scripts of this directory, this module is a pytest test
+module: run it with ``python -m pytest``.
+"""
+import numpy as np
+from scipy.interpolate import LinearNDInterpolator, splev, splrep
+
+import sdp.diagnostic.bes.tools as tools
+
+rng = np.random.RandomState(0)
+
+Nt = 60
+Nfib = 30
+R = 2.2 + 0.1*rng.rand(Nfib)
+Z = 0.05*rng.rand(Nfib) - 0.025
+Itot = 1 + 0.1*rng.rand(Nt, Nfib)
+
+
+def test_interpolation_weights():
+    t = tools.Tools(Itot, R, Z, R, 'test')
+    Nr, Nz = 20, 25
+    r, z, Igrid = t.interpolate(Nr, Nz, t.I, start=10)
+    assert t.interpolation_weights(Nr, Nz) is t.interpolation_weights(Nr, Nz)
+
+    rmesh, zmesh = np.meshgrid(r, z, indexing='ij')
+    interp = LinearNDInterpolator(np.array([R, Z]).T, t.I[:Nt-10, :].T,
+                                  fill_value=0)
+    ref = np.rollaxis(interp(rmesh, zmesh), -1)
+    np.testing.assert_allclose(Igrid, ref, rtol=1e-10, atol=1e-12)
+
+
+def test_correlation_coefficients():
+    I = rng.randn(Nt, 12)
+    ref = [np.corrcoef(I[:, 4], I[:, j])[0, 1] for j in range(12)]
+    np.testing.assert_allclose(tools.correlation_coefficients(I, 4), ref,
+                               rtol=1e-12, atol=1e-14)
+
+
+def test_spline_matrix():
+    x = np.sort(rng.rand(15))
+    xnew = np.linspace(x[0], x[-1], 40)
+    I = rng.randn(Nt, 15)
+    ref = np.array([splev(xnew, splrep(x, I[i, :])) for i in range(Nt)])
+    np.testing.assert_allclose(I.dot(tools.spline_matrix(x, xnew).T), ref,
+                               rtol=1e-10, atol=1e-12)
+
+
+def test_default_precision():
+    t = tools.Tools(Itot, R, Z, R, 'test')
+    Iav = np.mean(Itot, axis=0)
+    assert t.I.dtype == np.float64
+    np.testing.assert_array_equal(t.I, (Itot-Iav)/Iav)
+    t32 = tools.Tools(Itot, R, Z, R, 'test', dtype=np.float32)
+    assert t32.I.dtype == np.float32
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+test sdp.plasma.gtc.diag
+
+The spline evaluations are compared with the original formulas (sum over all
+the coefficients of the cell), on small random spline tables.
+
+Unlike the other scripts of this directory, this module is a pytest test
+module: run it with ``python -m pytest``.
+"""
+import json
+import os
+import stat
+
+import numpy as np
+import scipy.io.netcdf as nc
+
+import sdp.plasma.gtc.diag as diag
+
+npsi, ntheta, nzeta = 6, 9, 7
+rng = np.random.RandomState(0)
+
+
+def write_diag(filename):
+    raw_diag = {'npsi': npsi, 'ntheta': ntheta, 'spdim': 9,
+                'psi_separatrix': 0.7}
+    for name in ('x', 'z', 'b', 'jacobian_boozer', 'jacobian_metric'):
+        raw_diag[name] = rng.randn(ntheta*npsi*9).tolist()
+    for name in ('g', 'I', 'q'):
+        raw_diag[name] = rng.randn(npsi*3).tolist()
+    with open(filename, 'w') as f:
+        json.dump(raw_diag, f)
+
+
+def random_points(shape=(4, 5, 3)):
+    psi = rng.uniform(0, 1, shape)
+    theta = rng.uniform(-7, 7, shape)
+    zeta = rng.uniform(-7, 7, shape)
+    return psi, theta, zeta
+
+
+def test_diagnoser_splines(tmpdir):
+    filename = str(tmpdir.join('diag.json'))
+    write_diag(filename)
+    d = diag.Diagnoser(filename)
+    psi, theta, _ = random_points((6, 5))
+
+    n = np.floor(psi/d._dpsi).astype(np.intp)
+    psi_re = (psi - n*d._dpsi)*d._psi_separatrix
+    theta_r = np.remainder(theta, 2*np.pi)
+    m = np.floor(theta_r/d._dtheta).astype(np.intp)
+    theta_re = theta_r - m*d._dtheta
+    for name, sp in (('x', d.x_sp), ('z', d.z_sp), ('b', d.b_sp),
+                     ('jacobian_metric', d.jm_sp),
+                     ('jacobian_boozer', d.jb_sp)):
+        ymn = getattr(d, name)[m, n, :]
+        ref = sum(ymn[..., 3*t + p]*psi_re**p*theta_re**t
+                  for t in range(3) for p in range(3))
+        np.testing.assert_allclose(sp(psi, theta), ref, rtol=1e-12,
+                                   atol=1e-12)
+    for name, sp in (('g', d.g_sp), ('I', d.I_sp), ('q', d.q_sp)):
+        yn = getattr(d, name)[n, :]
+        ref = yn[..., 0] + yn[..., 1]*psi_re + yn[..., 2]*psi_re**2
+        np.testing.assert_allclose(sp(psi), ref, rtol=1e-12, atol=1e-12)
+
+
+def write_alpha(filename):
+    with nc.netcdf_file(filename, 'w') as f:
+        f.createDimension('npsi', npsi)
+        f.createDimension('ntheta', ntheta)
+        f.createDimension('nzeta', nzeta)
+        f.createDimension('spdim', 27)
+        sep = f.createVariable('psi_separatrix', 'd', ())
+        sep.data[...] = 0.7
+        alpha = f.createVariable('alpha', 'd', ('nzeta', 'ntheta', 'npsi',
+                                                'spdim'))
+        alpha[:] = rng.randn(nzeta, ntheta, npsi, 27)
+
+
+def alpha_reference(alpha, psi, theta, zeta, deriv):
+    """ original evaluation of the 3D spline """
+    theta = np.remainder(theta, 2*np.pi)
+    zeta = np.remainder(zeta, 2*np.pi)
+    i = np.floor(psi/alpha._dpsi).astype(np.intp)
+    psi_re = (psi - i*alpha._dpsi)*alpha._psi_separatrix
+    psi_re = np.where(i == 0, np.sqrt(psi_re), psi_re)
+    j = np.floor(theta/alpha._dtheta).astype(np.intp)
+    theta_re = theta - j*alpha._dtheta
+    k = np.floor(zeta/alpha._dzeta).astype(np.intp)
+    zeta_re = zeta - k*alpha._dzeta
+
+    def power(x, n, d):
+        if d:
+            return n*x**max(0, n-1)
+        return x**n
+    dx_vec = np.array([power(psi_re, p, deriv == 1) *
+                       power(theta_re, n, deriv == 2) *
+                       power(zeta_re, m, deriv == 3)
+                       for m in range(3) for n in range(3) for p in range(3)])
+    return np.sum(alpha._raw_alpha[k, j, i, :]*np.rollaxis(dx_vec, 0,
+                                                           dx_vec.ndim),
+                  axis=-1)
+
+
+def test_alpha_sp(tmpdir):
+    filename = str(tmpdir.join('alpha.nc'))
+    write_alpha(filename)
+    alpha = diag.AlphaDiagnoser(filename)
+    psi, theta, zeta = random_points()
+    cache = alpha.prepare(psi, theta, zeta)
+    for deriv in range(4):
+        ref = alpha_reference(alpha, psi, theta, zeta, deriv)
+        np.testing.assert_allclose(alpha.alpha_sp(psi, theta, zeta, deriv),
+                                   ref, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(alpha.alpha_sp_cached(cache, deriv), ref,
+                                   rtol=1e-12, atol=1e-12)
+
+
+def test_diagnoser_cache(tmpdir):
+    filename = str(tmpdir.join('diag.json'))
+    write_diag(filename)
+    os.chmod(filename, 0o644)
+    # an unrelated file with the base name must not be used as the cache
+    np.savez(str(tmpdir.join('diag.npz')), x=np.zeros(1))
+    ref = diag.Diagnoser(filename)
+    cache = filename + '.npz'
+    assert os.path.exists(cache)
+    # same permissions as the JSON file
+    assert stat.S_IMODE(os.stat(cache).st_mode) == 0o644
+
+    def check(d):
+        for name in ('x', 'z', 'b', 'g', 'I', 'q', 'jacobian_boozer',
+                     'jacobian_metric'):
+            np.testing.assert_array_equal(getattr(d, name),
+                                          getattr(ref, name))
+    check(diag.Diagnoser(filename))
+
+    # truncated cache: the JSON file is read again and the cache rewritten
+    with open(cache, 'rb') as f:
+        content = f.read()
+    with open(cache, 'wb') as f:
+        f.write(content[:len(content)//2])
+    check(diag.Diagnoser(filename))
+    assert os.path.getsize(cache) == len(content)
+
+    # new JSON content with an older modification time
+    mtime = os.stat(filename).st_mtime
+    write_diag(filename)
+    os.utime(filename, (mtime - 100, mtime - 100))
+    new = diag.Diagnoser(filename)
+    assert not np.array_equal(new.x, ref.x)
+
+
+def test_fourier_analysis(tmpdir):
+    filename = str(tmpdir.join('alpha.nc'))
+    write_alpha(filename)
+    alpha = diag.AlphaDiagnoser(filename)
+    psi = np.linspace(0.1, 0.9, 5)
+    mtheta, mzeta = 8, 6
+    theta_1d = np.linspace(0, 2*np.pi, mtheta)[0:-1]
+    zeta_1d = np.linspace(0, 2*np.pi, mzeta)[0:-1]
+    zeta_mesh, theta_mesh, psi_mesh = np.meshgrid(zeta_1d, theta_1d, psi,
+                                                  indexing='ij')
+    alpha_arr = alpha_reference(alpha, psi_mesh, theta_mesh, zeta_mesh, 0)
+    alpha_m = np.fft.fft(alpha_arr, axis=1)/mtheta
+    alpha_m = np.fft.ifftshift(np.flip(np.fft.fftshift(alpha_m, axes=1),
+                                       axis=1), axes=1)
+    ref = np.fft.fft(alpha_m, axis=0)/mzeta
+    np.testing.assert_allclose(alpha.fourier_analysis(psi, mtheta, mzeta),
+                               ref, rtol=1e-10, atol=1e-12)
@@ -11,7 +11,7 @@ import h5py as h5
 from scipy.spatial import Delaunay, ConvexHull
 from matplotlib.tri import Triangulation
 from matplotlib.tri import CubicTriInterpolator as cubic_interp
-from scipy.interpolate import griddata,CloughTocher2DInterpolator,interp1d,RectBivariateSpline
+from scipy.interpolate import griddata,CloughTocher2DInterpolator,RectBivariateSpline
 import scipy.io.netcdf as nc
 #import pickle
 
@@ -25,11 +25,11 @@ def get_interp_planes(my_xgc):
     if(my_xgc.CO_DIR):
         nextplane = np.searchsorted(phi_planes,my_xgc.grid.phi3D,side = 'right')
         prevplane = nextplane - 1
-        nextplane[np.nonzero(nextplane == my_xgc.n_plane)] = 0
+        nextplane %= my_xgc.n_plane
     else:
         prevplane = np.searchsorted(phi_planes,my_xgc.grid.phi3D,side = 'right')
         nextplane = prevplane - 1
-        prevplane[np.nonzero(prevplane == my_xgc.n_plane)] = 0
+        prevplane %= my_xgc.n_plane
 
     return (prevplane,nextplane)
     
@@ -262,10 +262,9 @@ def find_interp_positions_v2(my_xgc):
         dR_BWD = RdPhi_BWD * BR_BWD / BPhi_BWD
         dZ_BWD = RdPhi_BWD * BZ_BWD / BPhi_BWD
         
-        ind = np.where(np.abs(dR_BWD) == np.inf)[0]
-        dR_BWD[ind] = 0.0
-        ind = np.where(np.abs(dZ_BWD) == np.inf)[0]
-        dZ_BWD[ind] = 0.0
+        #infinite steps (vanishing BPhi) are set to zero
+        dR_BWD[np.isinf(dR_BWD)] = 0.0
+        dZ_BWD[np.isinf(dZ_BWD)] = 0.0
         
         s_BWD += np.sqrt(RdPhi_BWD**2 + dR_BWD**2 + dZ_BWD**2)
         R_BWD += dR_BWD
@@ -402,6 +401,25 @@ def find_interp_positions_v1(my_xgc):
     return interp_positions
 
 
+class ProfileInterpolator():
+    """Linear interpolator of an equilibrium profile on psi
+
+    Gives the same values as ``interp1d(psi,profile,bounds_error = False,fill_value = fill_value)`` but the evaluation is done by :func:`numpy.interp`, which avoids the overhead of the scipy interpolator.
+
+    :param psi: psi values of the profile, np.array[n_psi]
+    :param profile: profile values, np.array[n_psi]
+    :param float fill_value: value used outside of the psi range
+    """
+    def __init__(self,psi,profile,fill_value):
+        order = np.argsort(psi)
+        self.psi = np.asarray(psi,dtype = float)[order]
+        self.profile = np.asarray(profile,dtype = float)[order]
+        self.fill_value = fill_value
+
+    def __call__(self,psi):
+        return np.interp(psi,self.psi,self.profile,left = self.fill_value,right = self.fill_value)
+
+
 class XGC_Loader_Error(Exception):
     def __init__(self,value):
         self.value = value
@@ -641,13 +659,11 @@ class XGC_Loader():
         self.trifinder =  DelaunayTriFinder(self.Delaunay, self.triangulation)
         self.nextnode = mesh['nextnode'][...]
         
-        self.prevnode = np.zeros(self.nextnode.shape)
-        for i in range(len(self.nextnode)):
-            prevnodes = np.nonzero(self.nextnode == i)[0]
-            if( len(prevnodes)>0 ):
-                self.prevnode[i] = prevnodes[0]
-            else:
-                self.prevnode[i] = -1
+        # prevnode[i] is the first node j with nextnode[j] == i (-1 if none)
+        self.prevnode = -np.ones(self.nextnode.shape,dtype=int)
+        nodes, first = np.unique(self.nextnode, return_index=True)
+        valid = (nodes >= 0) & (nodes < len(self.nextnode))
+        self.prevnode[nodes[valid]] = first[valid]
         
         self.psi = np.copy(mesh['psi'][...])
         self.psi_interp = cubic_interp(self.triangulation, self.psi,  trifinder = self.trifinder)
@@ -840,10 +856,8 @@ class XGC_Loader():
         the mean value of these two quantities on each time step is also calculated.
         for multiple cross-section runs, data is stored under each center_plane index.
         """
-        #similar to the 2D case, we first read one file to determine the total toroidal plane number in the simulation
-        flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[0]).zfill(5)+'.h5'
-        fluc_mesh = h5.File(flucf,'r')
-
+        # the total toroidal plane number is already known from load_mesh_psi_3D,
+        # each file is opened only once in the loop below
         self.planes = np.unique(np.array([np.unique(self.prevplane),np.unique(self.nextplane)]))
         self.planeID = {self.planes[i]:i for i in range(len(self.planes))} #the dictionary contains the positions of each chosen plane, useful when we want to get the data on a given plane known only its plane number in xgc file.
         if(self.HaveElectron):
@@ -856,6 +870,15 @@ class XGC_Loader():
 
         self.phi = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])) )
         self.phi_bar = np.zeros((len(self.time_steps)))
+
+        # buffers for the content of the files (same shape for all the time steps)
+        # reused for all the files instead of allocating new arrays at each reading
+        shape = (len(self.mesh['R']),self.n_plane)
+        dpot = np.empty(shape)
+        if (self.HaveElectron):
+            eden = np.empty(shape)
+        if (self.load_ions):
+            iden = np.empty(shape)
         for i in range(len(self.time_steps)):
             flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[i]).zfill(5)+'.h5'
             fluc_mesh = h5.File(flucf,'r')
@@ -865,21 +888,24 @@ class XGC_Loader():
                 dn = int(self.n_plane/self.n_cross_section)
                 self.center_planes = np.arange(self.n_cross_section)*dn
 
-            self.phi_bar[i] = np.mean(fluc_mesh['dpot'][...])
+            # each dataset is read only once from the file
+            fluc_mesh['dpot'].read_direct(dpot)
+            self.phi_bar[i] = np.mean(dpot)
             if (self.HaveElectron):
-                self.nane_bar[i] = np.mean(fluc_mesh['eden'][...])
+                fluc_mesh['eden'].read_direct(eden)
+                self.nane_bar[i] = np.mean(eden)
             if (self.load_ions):
-                self.dni_bar[i] = np.mean(fluc_mesh['iden'][...])
+                fluc_mesh['iden'].read_direct(iden)
+                self.dni_bar[i] = np.mean(iden)
                 
             for j in range(self.n_cross_section):
-                self.phi[j,i] += np.swapaxes(fluc_mesh['dpot'][...][:,(self.center_planes[j] + self.planes)%self.n_plane],0,1)
-                self.phi[j,i] -= self.phi_bar[i]
+                planes = (self.center_planes[j] + self.planes)%self.n_plane
+                # the mean is removed while writing in the preallocated arrays
+                np.subtract(dpot.T[planes],self.phi_bar[i],out=self.phi[j,i])
                 if(self.HaveElectron):
-                    self.nane[j,i] += np.swapaxes(fluc_mesh['eden'][...][:,(self.center_planes[j] + self.planes)%self.n_plane],0,1)
-                    self.nane[j,i] -= self.nane_bar[i]
+                    np.subtract(eden.T[planes],self.nane_bar[i],out=self.nane[j,i])
                 if(self.load_ions):
-                    self.dni[j,i] += np.swapaxes(fluc_mesh['iden'][...][:,(self.center_planes[j] + self.planes)%self.n_plane],0,1)
-                    self.dni[j,i] -= self.dni_bar[i]
+                    np.subtract(iden.T[planes],self.dni_bar[i],out=self.dni[j,i])
             fluc_mesh.close()
             
         return 0
@@ -897,6 +923,7 @@ class XGC_Loader():
         fluc_mesh = h5.File(flucf,'r')
 
         self.n_plane = fluc_mesh['dpot'].shape[1]
+        fluc_mesh.close()
         dn = int(self.n_plane/self.n_cross_section)
         self.center_planes = np.arange(self.n_cross_section)*dn
 
@@ -954,32 +981,30 @@ class XGC_Loader():
         """Load equilibrium profiles, including ne0, Te0
         """
         eqf = self.xgc_path + 'xgc.oneddiag.h5'
-        eq_mesh = h5.File(eqf,'r')
-        eq_psi = eq_mesh['psi_mks'][:]
-
-        #sometimes eq_psi is stored as 2D array, which has time series infomation. For now, just use the time step 1 psi array as the unchanged array. NEED TO BE CHANGED if equilibrium psi mesh is changing over time.
-        n_psi = eq_psi.shape[-1]
-        eq_psi = eq_psi.flatten()[0:n_psi] #pick up the first n psi values.
+        # read all the profiles at once and close the file right away
+        with h5.File(eqf,'r') as eq_mesh:
+            #sometimes eq_psi is stored as 2D array, which has time series infomation. For now, just use the time step 1 psi array as the unchanged array. NEED TO BE CHANGED if equilibrium psi mesh is changing over time.
+            eq_psi = eq_mesh['psi_mks']
+            eq_psi = eq_psi[0] if eq_psi.ndim > 1 else eq_psi[:] #pick up the first n psi values.
+            eq_ti = eq_mesh['i_perp_temperature_1d'][0,:]
+            eq_ni = eq_mesh['i_gc_density_1d'][0,:]
+            self.HaveElectron = 'e_perp_temperature_1d' in eq_mesh
+            if self.HaveElectron:
+                eq_te = eq_mesh['e_perp_temperature_1d'][0,:]
+                eq_ne = eq_mesh['e_gc_density_1d'][0,:]
 
-        eq_ti = eq_mesh['i_perp_temperature_1d'][0,:]
-        eq_ni = eq_mesh['i_gc_density_1d'][0,:]
         ni_min = np.min(eq_ni)
-        self.ti0_sp = interp1d(eq_psi,eq_ti,bounds_error = False,fill_value = 0)
-        self.ni0_sp = interp1d(eq_psi,eq_ni,bounds_error = False,fill_value = ni_min/10)
-        if('e_perp_temperature_1d' in list(eq_mesh.keys()) ):
+        self.ti0_sp = ProfileInterpolator(eq_psi,eq_ti,fill_value = 0)
+        self.ni0_sp = ProfileInterpolator(eq_psi,eq_ni,fill_value = ni_min/10)
+        if self.HaveElectron:
             #simulation has electron dynamics
-            self.HaveElectron = True
-            eq_te = eq_mesh['e_perp_temperature_1d'][0,:]
-            eq_ne = eq_mesh['e_gc_density_1d'][0,:]
             te_min = np.min(eq_te)
             ne_min = np.min(eq_ne)
-            self.te0_sp = interp1d(eq_psi,eq_te,bounds_error = False,fill_value = te_min/2)
-            self.ne0_sp = interp1d(eq_psi,eq_ne,bounds_error = False,fill_value = ne_min/10)
+            self.te0_sp = ProfileInterpolator(eq_psi,eq_te,fill_value = te_min/2)
+            self.ne0_sp = ProfileInterpolator(eq_psi,eq_ne,fill_value = ne_min/10)
 
         else:
-            self.HaveElectron = False
-            self.load_eq_tene_nonElectronRun() 
-        eq_mesh.close()
+            self.load_eq_tene_nonElectronRun()
         
         self.te0 = self.te0_sp(self.psi)
         self.ne0 = self.ne0_sp(self.psi)
@@ -1000,13 +1025,13 @@ class XGC_Loader():
         psi_te, te = np.genfromtxt(te_fname,skip_header = 1,skip_footer = 1,unpack = True)
         psi_ne, ne = np.genfromtxt(ne_fname,skip_header = 1,skip_footer = 1,unpack = True)
 
-        psi_x = load_m(self.xgc_path + 'units.m')['psi_x']
+        psi_x = self.unit_dic['psi_x']
 
         psi_te *= psi_x
         psi_ne *= psi_x
 
-        self.te0_sp = interp1d(psi_te,te,bounds_error = False,fill_value = 0)
-        self.ne0_sp = interp1d(psi_ne,ne,bounds_error = False,fill_value = 0)
+        self.te0_sp = ProfileInterpolator(psi_te,te,fill_value = 0)
+        self.ne0_sp = ProfileInterpolator(psi_ne,ne,fill_value = 0)
         
 
     def calculate_dne_ad_2D3D(self):
@@ -1226,55 +1251,49 @@ class XGC_Loader():
                 self.dni_on_grid = np.zeros(self.dni_ad_on_grid.shape)
           
             interp_positions = find_interp_positions_v2_upgrade(self)
-    
+
+            #create index dictionary, for each key as plane number and value the corresponding indices where the plane is used as previous or next plane.
+            #These do not depend on the cross section nor on the time step, so they are computed only once.
+            prev_idx = {}
+            next_idx = {}
+            for j in range(len(self.planes)):
+                prev_idx[j] = np.where(self.prevplane == self.planes[j] )
+                next_idx[j] = np.where(self.nextplane == self.planes[j] )
+
+            def interp_on_grid(data, out):
+                """interpolate *data* of all the time steps onto the grid, writing the result into *out*
+
+                For each plane, all the time steps are put into a single interpolant, so the grid points are located in the triangulation and the gradients estimated only once per plane. The weighted values are accumulated directly into *out*, so no full size temporary array is created.
+
+                :param data: fluctuations of one cross section, shape (Ntime,Nplanes,Npoints)
+                :param out: zero initialized array of shape (Ntime,NZ,NY,NX), receives the fluctuations on grid
+                """
+                for j in range(len(self.planes)):
+                    if(prev_idx[j][0].size == 0 and next_idx[j][0].size == 0):
+                        continue
+                    interp = CloughTocher2DInterpolator(self.Delaunay,data[:,j,:].T, fill_value = 0)
+                    # on_grid values are linearly interpolated between the previous and the next plane
+                    if(prev_idx[j][0].size != 0):
+                        prev = interp(np.array([interp_positions[0,0][prev_idx[j]], interp_positions[0,1][prev_idx[j]] ]).T )
+                        prev *= interp_positions[1,2][prev_idx[j]][:,np.newaxis]
+                        out[(slice(None),)+prev_idx[j]] += prev.T
+                    if(next_idx[j][0].size != 0):
+                        next = interp(np.array([interp_positions[1,0][next_idx[j]], interp_positions[1,1][next_idx[j]] ]).T )
+                        next *= interp_positions[0,2][next_idx[j]][:,np.newaxis]
+                        out[(slice(None),)+next_idx[j]] += next.T
+
             for k in range(self.n_cross_section):
                 print('center plane {0}.'.format(self.center_planes[k]))
-                for i in range(len(self.time_steps)):
-                    print('time step {0}'.format(self.time_steps[i]))
-                    #for each time step, first create the 2 arrays of quantities for interpolation
-                    prev = np.zeros( (self.grid.NZ,self.grid.NY,self.grid.NX) )
-                    next = np.zeros(prev.shape)
-
-                    #create index dictionary, for each key as plane number and value the corresponding indices where the plane is used as previous or next plane.
-                    prev_idx = {}
-                    next_idx = {}
-                    for j in range(len(self.planes)):
-                        prev_idx[j] = np.where(self.prevplane == self.planes[j] )
-                        next_idx[j] = np.where(self.nextplane == self.planes[j] )
-    
-                    #now interpolate adiabatic ne on each toroidal plane for the points using it as previous or next plane.
-                    for j in range(len(self.planes)):
-                        if(prev[prev_idx[j]].size != 0):
-                            prev[prev_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.dne_ad[k,i,j,:], fill_value = 0)(np.array([interp_positions[0,0][prev_idx[j]], interp_positions[0,1][prev_idx[j]] ]).T )
-                        if(next[next_idx[j]].size != 0):
-                            next[next_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.dne_ad[k,i,j,:], fill_value = 0)(np.array([interp_positions[1,0][next_idx[j]], interp_positions[1,1][next_idx[j]] ]).T )
-                    # on_grid adiabatic ne is then calculated by linearly interpolating values between these two planes
-                
-                    self.dne_ad_on_grid[k,i,...] = prev * interp_positions[1,2,...] + next * interp_positions[0,2,...]
+                interp_on_grid(self.dne_ad[k], self.dne_ad_on_grid[k])
 
-    
-                    if self.HaveElectron:
-                        #non-adiabatic ne data as well:
-                        for j in range(len(self.planes)):
-                            if(prev[prev_idx[j]].size != 0):
-                                prev[prev_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.nane[k,i,j,:], fill_value = 0)(np.array([interp_positions[0,0][prev_idx[j]], interp_positions[0,1][prev_idx[j]] ]).T )
-                            if(next[next_idx[j]].size != 0):
-                                next[next_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.nane[k,i,j,:], fill_value = 0)(np.array([interp_positions[1,0][next_idx[j]], interp_positions[1,1][next_idx[j]] ]).T )
-                        self.nane_on_grid[k,i,...] = prev * interp_positions[1,2,...] + next * interp_positions[0,2,...]
-                        
-                    """   NOW WE WORK WITH IONS   """
-                        
-                    if self.load_ions:
-                        #for each time step, first create the 2 arrays of quantities for interpolation
-                        prev = np.zeros( (self.grid.NZ,self.grid.NY,self.grid.NX) )
-                        next = np.zeros(prev.shape)
-  
-                        for j in range(len(self.planes)):
-                            if(prev[prev_idx[j]].size != 0):
-                                prev[prev_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.dni[k,i,j,:], fill_value = 0)(np.array([interp_positions[0,0][prev_idx[j]], interp_positions[0,1][prev_idx[j]] ]).T )
-                            if(next[next_idx[j]].size != 0):
-                                next[next_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.dni[k,i,j,:], fill_value = 0)(np.array([interp_positions[1,0][next_idx[j]], interp_positions[1,1][next_idx[j]] ]).T )                           
-                        self.dni_on_grid[k,i,...] = prev * interp_positions[1,2,...] + next * interp_positions[0,2,...]
+                if self.HaveElectron:
+                    #non-adiabatic ne data as well:
+                    interp_on_grid(self.nane[k], self.nane_on_grid[k])
+
+                """   NOW WE WORK WITH IONS   """
+
+                if self.load_ions:
+                    interp_on_grid(self.dni[k], self.dni_on_grid[k])
 
 
     def interp_check(self, tol = 0.2, toroidal_cross = 0, time = 0):
@@ -1513,41 +1532,45 @@ class XGC_Loader():
         
         """
         file_start = output_path + filehead
+        # the equilibrium quantities are the same in all the files
+        te_keV = self.te_on_grid/1000
+        ti_keV = self.ti_on_grid/1000
         for i in range(self.n_cross_section):
             for j in range(len(self.time_steps)):
-            
-                fname = file_start + str(self.time_steps[j])+'_'+str(i) + '.cdf'
-                f = nc.netcdf_file(fname,'w')
-                f.createDimension('z_dim',self.grid.NZ)
-                f.createDimension('r_dim',self.grid.NR)
-
-                rr = f.createVariable('rr','d',('r_dim',))
-                rr[:] = self.grid.R1D[:]
-                zz = f.createVariable('zz','d',('z_dim',))
-                zz[:] = self.grid.Z1D[:]
-                rr.units = zz.units = 'Meter'
-
-                bb = f.createVariable('bb','d',('z_dim','r_dim'))
-                bb[:,:] = self.B_on_grid[:,:]
-                bb.units = 'Tesla'
-                
-                dne = f.createVariable('dne','d',('z_dim','r_dim'))                
-                dne[:,:] = self.dne_ad_on_grid[i,j,:,:] + self.nane_on_grid[i,j,:,:]
-                dne.units = 'per cubic meter'
-                
-                ne = f.createVariable('ne','d',('z_dim','r_dim'))
-                ne[:,:] = self.ne0_on_grid[:,:] + dne[:,:]
-                ne.units = 'per cubic meter'
-
-                te = f.createVariable('te','d',('z_dim','r_dim'))
-                te[:,:] = self.te_on_grid[:,:]/1000
-                te.units = 'keV'
-                
-                ti = f.createVariable('ti','d',('z_dim','r_dim'))
-                ti[:,:] = self.ti_on_grid[:,:]/1000
-                ti.units = 'keV'
 
-                f.close()
+                fname = file_start + str(self.time_steps[j])+'_'+str(i) + '.cdf'
+                with nc.netcdf_file(fname,'w') as f:
+                    f.createDimension('z_dim',self.grid.NZ)
+                    f.createDimension('r_dim',self.grid.NR)
+
+                    rr = f.createVariable('rr','d',('r_dim',))
+                    rr[:] = self.grid.R1D[:]
+                    zz = f.createVariable('zz','d',('z_dim',))
+                    zz[:] = self.grid.Z1D[:]
+                    rr.units = zz.units = 'Meter'
+
+                    bb = f.createVariable('bb','d',('z_dim','r_dim'))
+                    bb[:,:] = self.B_on_grid[:,:]
+                    bb.units = 'Tesla'
+
+                    # the densities are computed directly in the buffers of the
+                    # variables (see cdf_output_3D)
+                    dne = f.createVariable('dne','d',('z_dim','r_dim'))
+                    dne_data = dne.data
+                    np.add(self.dne_ad_on_grid[i,j],self.nane_on_grid[i,j],out=dne_data)
+                    dne.units = 'per cubic meter'
+
+                    ne = f.createVariable('ne','d',('z_dim','r_dim'))
+                    np.add(self.ne0_on_grid,dne_data,out=ne.data)
+                    ne.units = 'per cubic meter'
+
+                    te = f.createVariable('te','d',('z_dim','r_dim'))
+                    te[:,:] = te_keV
+                    te.units = 'keV'
+
+                    ti = f.createVariable('ti','d',('z_dim','r_dim'))
+                    ti[:,:] = ti_keV
+                    ti.units = 'keV'
 
     def cdf_output_3D(self,output_path = './',eq_filename = 'equilibrium3D.cdf',flucfilehead='fluctuation',WithBp=True):
         """write out cdf files for FWR3D code to use
@@ -1643,26 +1666,31 @@ class XGC_Loader():
             for j in range(self.n_cross_section):
                 for i in range(len(self.time_steps)):
                     fname = file_start + str(self.time_steps[i]) +'_'+ str(j)+ '.cdf'
-                    f = nc.netcdf_file(fname,'w')
-                    f.createDimension('nx',self.grid.NX)
-                    f.createDimension('ny',self.grid.NY)
-                    f.createDimension('nz',self.grid.NZ)
-    
-                    xx = f.createVariable('xx','d',('nx',))
-                    xx[:] = self.grid.X1D[:]
-                    yy = f.createVariable('yy','d',('ny',))
-                    yy[:] = self.grid.Y1D[:]
-                    zz = f.createVariable('zz','d',('nz',))
-                    zz[:] = self.grid.Z1D[:]            
-                    xx.units = yy.units = zz.units = 'm'
-                
-                    dne = f.createVariable('dne','d',('nz','ny','nx'))
-                    dne.units = 'm^-3'
-                    if(not self.HaveElectron):
-                        dne[:,:,:] = self.dne_ad_on_grid[j,i,:,:,:]*self.dn_amplifier          
-                    else:
-                        dne[:,:,:] = (self.dne_ad_on_grid[j,i,:,:,:] + self.nane_on_grid[j,i,:,:,:])*self.dn_amplifier
-                    f.close()
+                    with nc.netcdf_file(fname,'w') as f:
+                        f.createDimension('nx',self.grid.NX)
+                        f.createDimension('ny',self.grid.NY)
+                        f.createDimension('nz',self.grid.NZ)
+
+                        xx = f.createVariable('xx','d',('nx',))
+                        xx[:] = self.grid.X1D[:]
+                        yy = f.createVariable('yy','d',('ny',))
+                        yy[:] = self.grid.Y1D[:]
+                        zz = f.createVariable('zz','d',('nz',))
+                        zz[:] = self.grid.Z1D[:]
+                        xx.units = yy.units = zz.units = 'm'
+
+                        dne = f.createVariable('dne','d',('nz','ny','nx'))
+                        dne.units = 'm^-3'
+                        # the perturbation is computed directly in the buffer
+                        # of the variable, without full size temporaries.
+                        # (the buffer must not be reassigned through dne.data,
+                        # which would store it as a netcdf attribute)
+                        dne_data = dne.data
+                        if(not self.HaveElectron):
+                            np.multiply(self.dne_ad_on_grid[j,i],self.dn_amplifier,out=dne_data)
+                        else:
+                            np.add(self.dne_ad_on_grid[j,i],self.nane_on_grid[j,i],out=dne_data)
+                            dne_data *= self.dn_amplifier
     
         
 
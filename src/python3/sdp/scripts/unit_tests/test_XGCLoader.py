@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+test the interpolation helpers of sdp.plasma.xgc.loader and
+sdp.plasma.xgc.loader_local
+
+They are compared with the original interpolants on a small synthetic mesh.
+
+Unlike the other scripts of this directory, this module is a pytest test
+module: run it with ``python -m pytest``.
+"""
+import numpy as np
+from scipy.interpolate import LinearNDInterpolator, interp1d
+from scipy.spatial import Delaunay
+
+import sdp.plasma.xgc.loader as loader
+import sdp.plasma.xgc.loader_local as loader_local
+
+rng = np.random.RandomState(0)
+
+# disc shaped mesh in (R,Z)
+r = np.sqrt(rng.rand(2000))
+t = 2*np.pi*rng.rand(2000)
+points = np.array([2 + 0.5*r*np.cos(t), 0.5*r*np.sin(t)]).T
+tri = Delaunay(points)
+
+
+def test_sample_on_grid():
+    pts = np.array([2 + 1.2*(rng.rand(5000) - 0.5),
+                    1.2*(rng.rand(5000) - 0.5)]).T
+    inside = tri.find_simplex(pts) >= 0
+    psi = np.sum((points - [2, 0])**2, axis=1)
+    B = np.array([points[:, 0], points[:, 1], points[:, 0]*points[:, 1]]).T
+    for values, fill_value in ((psi, np.nan), (B, np.inf)):
+        interp = LinearNDInterpolator(tri, values, fill_value=fill_value)
+        grid = loader_local.sample_on_grid(interp, points, (50, 60),
+                                           fill_value)
+        ref = interp(pts[:, 0], pts[:, 1])
+        res = grid(pts[:, 0], pts[:, 1])
+        np.testing.assert_array_equal(grid(pts), res)
+        # same flags outside of the mesh, finite values inside
+        np.testing.assert_array_equal(np.isfinite(res), np.isfinite(ref))
+        assert np.all(np.isfinite(res[inside]))
+        # linear interpolation error of the grid
+        np.testing.assert_allclose(res[inside], ref[inside], atol=2e-3)
+
+
+def test_group_by_plane():
+    planes = np.arange(8)
+    plane = rng.randint(0, 8, 500)
+    groups = loader_local.group_by_plane(plane, planes)
+    for j in planes:
+        np.testing.assert_array_equal(groups[j], np.nonzero(plane == j)[0])
+
+
+def test_profile_interpolator():
+    psi = rng.permutation(np.linspace(0, 1.2, 50))
+    profile = np.exp(-psi)
+    psi_new = np.linspace(-0.2, 1.4, 300)
+    ref = interp1d(psi, profile, bounds_error=False, fill_value=0.1)(psi_new)
+    interp = loader.ProfileInterpolator(psi, profile, fill_value=0.1)
+    np.testing.assert_allclose(interp(psi_new), ref, rtol=1e-14, atol=1e-14)